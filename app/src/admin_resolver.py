@@ -0,0 +1,141 @@
+import json
+
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from constants import ADMIN_BOUNDARIES_PATH, ADMIN_LEVEL_PROPERTY, ADMIN_NAME_PROPERTY, ADMIN_LEVELS, \
+    ADMIN_GRID_SIZE
+
+# points x edges compared at once by the point-in-polygon test
+PIP_CHUNK = 4_000_000
+
+
+class Boundary:
+    """
+    A (multi)polygon as flat edge arrays. Holes and parts are handled by the even-odd rule over all rings.
+    """
+
+    def __init__(self, name, rings):
+        self.name = name
+        x1, y1, x2, y2 = [], [], [], []
+        for ring in rings:
+            ring = np.asarray(ring, dtype=float)[:, :2]
+            x1.append(ring[:-1, 0])
+            y1.append(ring[:-1, 1])
+            x2.append(ring[1:, 0])
+            y2.append(ring[1:, 1])
+        self.x1, self.y1 = np.concatenate(x1), np.concatenate(y1)
+        self.x2, self.y2 = np.concatenate(x2), np.concatenate(y2)
+        self.bbox = (min(self.x1.min(), self.x2.min()), min(self.y1.min(), self.y2.min()),
+                     max(self.x1.max(), self.x2.max()), max(self.y1.max(), self.y2.max()))
+
+    def contains(self, x, y):
+        """
+        Vectorized even-odd ray casting.
+
+        :param x: np.ndarray of longitudes
+        :param y: np.ndarray of latitudes
+        :return: np.ndarray of bool
+        """
+        inside = np.zeros(len(x), dtype=bool)
+        step = max(1, PIP_CHUNK // len(self.x1))
+        for start in range(0, len(x), step):
+            px = x[start:start + step, None]
+            py = y[start:start + step, None]
+            crosses = (self.y1 > py) != (self.y2 > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = (self.x2 - self.x1) * (py - self.y1) / (self.y2 - self.y1) + self.x1
+            inside[start:start + step] = np.count_nonzero(crosses & (px < x_cross), axis=1) % 2 == 1
+        return inside
+
+
+def geometry_rings(geometry):
+    if geometry['type'] == 'Polygon':
+        return geometry['coordinates']
+    if geometry['type'] == 'MultiPolygon':
+        return [ring for polygon in geometry['coordinates'] for ring in polygon]
+    return []
+
+
+class AdminResolver:
+    """
+    Offline municipality/county/state lookup: boundary polygons loaded from GeoJSON and indexed
+    by a uniform grid of their bounding boxes. Whole coordinate columns are resolved per grid cell,
+    so each polygon is only tested against the points of cells it may cover.
+    """
+
+    def __init__(self, path=ADMIN_BOUNDARIES_PATH, levels=ADMIN_LEVELS, grid_size=ADMIN_GRID_SIZE):
+        self.grid_size = grid_size
+        self.columns = list(dict.fromkeys(levels.values()))
+
+        with open(path, encoding='utf-8') as f:
+            features = json.load(f)['features']
+
+        # column -> boundaries, the most detailed admin level first
+        self.boundaries = defaultdict(list)
+        for feature in sorted(features, key=lambda feature: -int(
+                feature['properties'].get(ADMIN_LEVEL_PROPERTY) or 0)):
+            properties = feature['properties']
+            column = levels.get(str(properties.get(ADMIN_LEVEL_PROPERTY)))
+            rings = geometry_rings(feature.get('geometry') or {'type': None})
+            if column is None or not rings:
+                continue
+            self.boundaries[column].append(Boundary(properties.get(ADMIN_NAME_PROPERTY), rings))
+
+        # grid cell -> indexes of boundaries whose bounding box overlaps it, per column
+        self.grid = {column: defaultdict(list) for column in self.columns}
+        for column, boundaries in self.boundaries.items():
+            for i, boundary in enumerate(boundaries):
+                min_x, min_y, max_x, max_y = (int(np.floor(value / grid_size)) for value in boundary.bbox)
+                for cell_x in range(min_x, max_x + 1):
+                    for cell_y in range(min_y, max_y + 1):
+                        self.grid[column][(cell_x, cell_y)].append(i)
+        print(f'Loaded {sum(len(b) for b in self.boundaries.values())} boundaries from {path}')
+
+    def resolve(self, lat_values, lon_values):
+        """
+        :return: pd.DataFrame with one column per admin level, aligned to the index of lat_values;
+                 None where a point is outside all boundaries of a level or its coordinates are missing
+        """
+        lat = pd.to_numeric(pd.Series(lat_values), errors='coerce')
+        lon = pd.to_numeric(pd.Series(lon_values, index=lat.index), errors='coerce')
+        result = pd.DataFrame(None, index=lat.index, columns=self.columns, dtype=object)
+
+        valid = (lat.notna() & lon.notna()).to_numpy()
+        x, y = lon.to_numpy(dtype=float)[valid], lat.to_numpy(dtype=float)[valid]
+        if not len(x):
+            return result
+
+        cell_x = np.floor(x / self.grid_size).astype(np.int64)
+        cell_y = np.floor(y / self.grid_size).astype(np.int64)
+        order = np.lexsort((cell_y, cell_x))
+        cells = np.stack([cell_x[order], cell_y[order]], axis=1)
+        _, starts = np.unique(cells, axis=0, return_index=True)
+        ends = np.append(starts[1:], len(order))
+
+        for column in self.columns:
+            names = np.full(len(x), None, dtype=object)
+            for start, end in zip(starts, ends):
+                points = order[start:end]
+                for i in self.grid[column].get((int(cells[start, 0]), int(cells[start, 1])), []):
+                    todo = points[names[points] == None]  # noqa: E711, element-wise comparison
+                    if not len(todo):
+                        break
+                    boundary = self.boundaries[column][i]
+                    names[todo[boundary.contains(x[todo], y[todo])]] = boundary.name
+            result.loc[valid, column] = names
+        return result
+
+
+@lru_cache(maxsize=1)
+def get_default_resolver():
+    """
+    :return: AdminResolver over ADMIN_BOUNDARIES_PATH, or None if the file doesn't exist
+    """
+    if not Path(ADMIN_BOUNDARIES_PATH).exists():
+        return None
+    return AdminResolver(ADMIN_BOUNDARIES_PATH)
@@ -1,36 +1,118 @@
+import argparse
 import datetime
 import os
-import time
+import signal
+import sys
+import threading
 import schedule
 
 from pathlib import Path
 
 from scraper import Scraper
+from constants import OUTPUT_FOLDER
+from geo_and_xlsx_conversion import setup_logging
+from jobs import Job, JobRunner, PRIORITY_TRIGGER, PRIORITY_UPDATE, PRIORITY_BACKFILL, poll_triggers, \
+    request_trigger
 
 
 class App:
 
+    def __init__(self):
+        self.scraper = None
+        self.runner = None
+        self.stopping = threading.Event()
+
+    def initial_run(self, years):
+        """
+        Collect old data for previously dates until now, or update the current year if nothing was missing.
+        :param years: list of int, missing years
+        :return: None
+        """
+        updated_mark = self.scraper.collect_old_data(years)
+        if not updated_mark:
+            self.scraper.update_data()
+
+    def submit_initial_jobs(self):
+        """
+        The backfill job owns the missing years and the current year, which it updates if nothing is missing,
+        so on-demand triggers for other years run alongside it. Years collected by earlier runs are geocoded
+        by their own jobs, in case some of their opstinas still need it.
+        :return: None
+        """
+        current_year = datetime.datetime.now().year
+        missing = self.scraper.missing_years()
+        owned = set(missing) | {current_year}
+        self.runner.submit(Job('collect_old_data', self.initial_run, (missing,), priority=PRIORITY_BACKFILL,
+                               years=owned))
+        for year in self.scraper.store.years():
+            if year not in owned:
+                self.runner.submit(Job(f'geocode {year}', self.geocode_year, (year,),
+                                       priority=PRIORITY_BACKFILL, years=[year]))
+
+    def geocode_year(self, year):
+        """
+        Geocode the opstinas of a collected year which still need it, and render the result file if any changed.
+        :param year: int
+        :return: None
+        """
+        if self.scraper.geocode_years([year]):
+            self.scraper.get_result_file()
+
+    def submit_update(self):
+        self.runner.submit(Job('update_data', self.scraper.update_data, priority=PRIORITY_UPDATE,
+                               years=[datetime.datetime.now().year]))
+
+    def submit_triggers(self):
+        for year, opstinas in poll_triggers():
+            name = f'collect {year}' + (f' {",".join(sorted(opstinas))}' if opstinas else '')
+            self.runner.submit(Job(name, self.scraper.collect_on_demand, (year, opstinas),
+                                   priority=PRIORITY_TRIGGER, years=[year]))
+
+    def stop(self, signum, frame):
+        if self.stopping.is_set():
+            # second signal: don't wait for the running jobs
+            sys.exit(1)
+        print(f'Received signal {signum}, stopping')
+        self.stopping.set()
+
     def run(self):
         """
         It collects old data for previously dates until now and runs circle for updating data.
+        Jobs run on a bounded JobRunner; on-demand triggers are polled every second.
+        SIGINT/SIGTERM stop the service once the running jobs are finished.
         :return: None
         """
         # create directory "data"
         os.makedirs(Path("../data/"), exist_ok=True)
+        setup_logging(OUTPUT_FOLDER)
 
-        scraper = Scraper()
-        updated_mark = scraper.collect_old_data()
-        if not updated_mark:
-            scraper.update_data()
+        self.scraper = Scraper()
+        self.runner = JobRunner()
+        self.runner.start()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        self.submit_initial_jobs()
 
         # get new data every week
-        schedule.every().monday.at("00:00").do(scraper.update_data)
-        while True:
+        schedule.every().monday.at("00:00").do(self.submit_update)
+        while not self.stopping.wait(1):
             schedule.run_pending()
-            time.sleep(1)
+            self.submit_triggers()
+        self.runner.shutdown()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Collect katastar contracts; with --year, trigger the running service')
+    parser.add_argument('--year', type=int, help='collect this year now')
+    parser.add_argument('--opstina', action='append', help='only this opstina of the year (repeatable)')
+    args = parser.parse_args()
+    if args.year is not None:
+        print(f'Trigger written to {request_trigger(args.year, args.opstina)}')
+        sys.exit()
+    elif args.opstina:
+        parser.error('--opstina needs --year')
+
     try:
         app = App()
         app.run()
@@ -0,0 +1,75 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+
+from pathlib import Path
+
+from constants import ARCHIVE_FOLDER, ARCHIVE_RESPONSES
+
+
+class ResponseArchive:
+    """
+    Gzipped raw responses, content-addressed by the request parameters:
+    <root>/<namespace>/[<partition>/]<sha256 of the parameters>.json.gz
+
+    An offline archive never goes to the network: callers read responses from it instead.
+    """
+
+    def __init__(self, root=ARCHIVE_FOLDER, enabled=ARCHIVE_RESPONSES, offline=False):
+        self.root = Path(root)
+        self.enabled = enabled or offline
+        self.offline = offline
+
+    @staticmethod
+    def key(params):
+        return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def path(self, namespace, params, partition=None):
+        key = self.key(params)
+        folder = self.root.joinpath(namespace, partition or key[:2])
+        return folder.joinpath(f'{key}.json.gz')
+
+    def put(self, namespace, params, text, partition=None):
+        """
+        Store the response text of a request; a later response to the same request replaces it.
+        """
+        if not self.enabled or self.offline:
+            return
+        path = self.path(namespace, params, partition)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({'params': params, 'archived_at': time.time(), 'response': text}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def get(self, namespace, params, partition=None):
+        """
+        :return: str, the archived response text, or None
+        """
+        path = self.path(namespace, params, partition)
+        if not path.exists():
+            return None
+        return self.read(path)['response']
+
+    @staticmethod
+    def read(path):
+        """
+        :return: dict with 'params', 'archived_at' and 'response'
+        """
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def partitions(self, namespace):
+        """
+        :return: list of str, partitions of a namespace
+        """
+        folder = self.root.joinpath(namespace)
+        if not folder.exists():
+            return []
+        return sorted(path.relative_to(folder).as_posix() for path in folder.glob('**/') if path != folder
+                      and any(path.glob('*.json.gz')))
+
+    def files(self, namespace, partition):
+        return sorted(self.root.joinpath(namespace, partition).glob('*.json.gz'))
@@ -0,0 +1,335 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS isn't reported there
+    resource = None
+
+from collector import CollectionEngine
+from constants import BENCHMARK_FOLDER, COLLECT_MAX_CONCURRENCY, COLLECT_RATE_LIMIT
+from scraper import Scraper
+
+LANDING_PAGE = '''<html><body><form>
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="BENCHMARK" />
+<input type="hidden" name="__VIEWSTATEGENERATOR" id="__VIEWSTATEGENERATOR" value="BENCHMARK" />
+<input type="hidden" name="__EVENTVALIDATION" id="__EVENTVALIDATION" value="BENCHMARK" />
+<select name="Opstina"><option value="-1">--- Opstina ---</option>{options}</select>
+<fieldset></fieldset><fieldset></fieldset>
+<fieldset><dl>
+<dd><span><input value="1" /><input value="2" /></span></dd>
+<dd><span><input value="3" /></span></dd>
+<dd><span><input value="4" /><input value="5" /></span></dd>
+</dl></fieldset>
+</form></body></html>'''
+
+CONTRACT_TYPES = ['Купопродаја', 'Поклон', 'Размена']
+CATEGORIES = ['Стан', 'Кућа', 'Гаража', 'Пословни простор', 'Пољопривредно земљиште']
+
+
+class FakeServer:
+    """
+    Local HTTP server on a free port with a fixed added latency and a share of requests answered with 503.
+    Subclasses implement respond(method, path, body) -> (content type, str).
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_request(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                with server._lock:
+                    server.requests += 1
+                    failed = server.random.random() < server.error_rate
+                    if failed:
+                        server.errors += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if failed:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                content_type, text = server.respond(method, self.path, body)
+                payload = text.encode('utf-8')
+                with server._lock:
+                    server.bytes_sent += len(payload)
+                self.send_response(200)
+                self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def respond(self, method, path, body):
+        raise NotImplementedError
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeKatastar(FakeServer):
+    """
+    Stand-in for the katastar landing page, its KO postback and Default.aspx/Data.
+    Contracts are synthetic but deterministic for a (opstina, KO, window); objects are placed in a pool
+    of buildings per KO, so nearby and repeated coordinates occur as in the real data.
+    """
+
+    def __init__(self, opstinas=10, kat_opstinas=5, contracts=50, objects=2, buildings=40, **kwargs):
+        super().__init__(**kwargs)
+        self.opstinas = [str(70000 + i) for i in range(opstinas)]
+        self.kat_opstinas = kat_opstinas
+        self.contracts = contracts
+        self.objects = objects
+        self.buildings = buildings
+
+    def respond(self, method, path, body):
+        if method == 'GET':
+            options = ''.join(f'<option value="{opst}">Opstina {opst}</option>' for opst in self.opstinas)
+            return 'text/html', LANDING_PAGE.format(options=options)
+        if path.endswith('Default.aspx/Data'):
+            request = json.loads(body)
+            ugovori = self.ugovori(request['OpstinaID'], request['KoID'], request['DatumPocetak'],
+                                   request['DatumZavrsetak'])
+            return 'application/json', json.dumps({'d': {'Ugovori': ugovori}}, ensure_ascii=False)
+        opst = parse_qs(body)['Opstina'][0]
+        options = ''.join(f'<option value="{opst}{ko:03d}">KO {ko}</option>' for ko in range(self.kat_opstinas))
+        return 'text/html', f'<select name="KatastarskaOpstina">{options}</select>'
+
+    def ugovori(self, opst, kat_opst, start_date, finish_date):
+        start = datetime.strptime(start_date, '%d.%m.%Y')
+        finish = datetime.strptime(finish_date, '%d.%m.%Y')
+        rnd = random.Random(f'{kat_opst}/{start_date}/{finish_date}')
+        # contracts are spread evenly over the year, a window gets its share
+        n = max(1, round(self.contracts * ((finish - start).days + 1) / 365))
+        ko_rnd = random.Random(kat_opst)
+        center_lat, center_lon = ko_rnd.uniform(42.3, 46.1), ko_rnd.uniform(19.0, 22.9)
+        buildings = [(center_lat + ko_rnd.uniform(-0.02, 0.02), center_lon + ko_rnd.uniform(-0.02, 0.02))
+                     for _ in range(self.buildings)]
+
+        ugovori = {}
+        for i in range(n):
+            contract_id = int(f'{start.year % 100:02d}{int(kat_opst) % 10 ** 8:08d}{start.timetuple().tm_yday:03d}{i:04d}')
+            date = start + (finish - start) * rnd.random()
+            objects = []
+            for j in range(self.objects):
+                lat, lon = rnd.choice(buildings)
+                objects.append({
+                    'pID': contract_id * 10 + j,
+                    'vNepNaziv': rnd.choice(CATEGORIES),
+                    'pov': rnd.choice([None, round(rnd.uniform(15, 300), 2)]),
+                    # a few meters of jitter around the building
+                    'latlon': {'Lat': lat + rnd.uniform(-3e-5, 3e-5), 'Lon': lon + rnd.uniform(-3e-5, 3e-5)},
+                })
+            ugovori[str(contract_id)] = {
+                'uID': contract_id,
+                'datumU': date.strftime('%Y-%m-%dT00:00:00'),
+                'ppNaziv': rnd.choice(CONTRACT_TYPES),
+                'vPromNaziv': 'Промет',
+                'cena': round(rnd.uniform(5_000, 500_000), 2),
+                'cenaV': 'EUR',
+                'n': objects,
+            }
+        return ugovori
+
+
+class FakeNominatim(FakeServer):
+    """
+    Stand-in for Nominatim /reverse, answering with a synthetic address of the coordinates.
+    """
+
+    def respond(self, method, path, body):
+        query = parse_qs(urlparse(path).query)
+        lat, lon = float(query['lat'][0]), float(query['lon'][0])
+        cell = f'{lat:.2f}/{lon:.2f}'
+        address = {
+            'house_number': str(int(lat * 1e5) % 200),
+            'road': f'Ulica {int(lon * 1e3) % 500}',
+            'city': f'Grad {cell}',
+            'county': f'Okrug {lat:.0f}',
+            'state': 'Centralna Srbija',
+            'postcode': str(11000 + int(lon * 100) % 1000),
+            'country': 'Srbija',
+        }
+        display_name = ', '.join(address[key] for key in ('house_number', 'road', 'city', 'county', 'country'))
+        return 'application/json', json.dumps({'display_name': display_name, 'address': address},
+                                              ensure_ascii=False)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class BenchmarkScraper(Scraper):
+    """
+    Scraper which also accumulates the time spent in parse_data (across fetch threads).
+    """
+
+    parse_time = 0
+    _parse_lock = threading.Lock()
+
+    @staticmethod
+    def parse_data(raw_data, kat_opstina=None):
+        started = time.perf_counter()
+        df = Scraper.parse_data(raw_data, kat_opstina)
+        with BenchmarkScraper._parse_lock:
+            BenchmarkScraper.parse_time += time.perf_counter() - started
+        return df
+
+
+def run_benchmark(years=(2023,), opstinas=10, kat_opstinas=5, contracts=50, objects=2, katastar_latency=0.05,
+                  nominatim_latency=0.02, error_rate=0.0, max_concurrency=COLLECT_MAX_CONCURRENCY,
+                  rate_limit=COLLECT_RATE_LIMIT):
+    """
+    Collect, geocode and export synthetic years against local fake servers in a temporary data folder.
+
+    :return: dict with the parameters, per-stage seconds, rows/s, requests/s and peak RSS
+    """
+    katastar = FakeKatastar(opstinas, kat_opstinas, contracts, objects, latency=katastar_latency,
+                            error_rate=error_rate)
+    nominatim = FakeNominatim(latency=nominatim_latency, error_rate=error_rate, seed=1)
+    cwd = os.getcwd()
+    workdir = tempfile.TemporaryDirectory(prefix='benchmark_')
+    # modules use paths relative to app/src, i.e. ../data
+    os.makedirs(os.path.join(workdir.name, 'src'))
+    os.chdir(os.path.join(workdir.name, 'src'))
+    stages = {}
+    try:
+        started = time.perf_counter()
+        scraper = BenchmarkScraper(base_url=katastar.url, nominatim_url=nominatim.url.rstrip('/'))
+        scraper.engine = CollectionEngine(max_concurrency, rate_limit)
+        BenchmarkScraper.parse_time = 0
+
+        requests_before = katastar.requests
+        stage_started = time.perf_counter()
+        scraper.collect_years(list(years))
+        scrape_seconds = time.perf_counter() - stage_started
+        rows = sum(len(scraper.store.read_year('contracts', year)) for year in years)
+        stages['scrape'] = {'seconds': scrape_seconds, 'rows': rows, 'requests': katastar.requests - requests_before}
+        # parsing runs inside the scrape stage; its time is summed over the fetch threads
+        stages['parse'] = {'seconds': BenchmarkScraper.parse_time, 'rows': rows, 'requests': 0}
+
+        stage_started = time.perf_counter()
+        scraper.geocode_years(list(years))
+        stages['geocode'] = {'seconds': time.perf_counter() - stage_started, 'rows': rows,
+                             'requests': nominatim.requests}
+
+        stage_started = time.perf_counter()
+        scraper.get_result_file()
+        stages['export'] = {'seconds': time.perf_counter() - stage_started, 'rows': rows, 'requests': 0}
+        total = time.perf_counter() - started
+    finally:
+        os.chdir(cwd)
+        katastar.stop()
+        nominatim.stop()
+        workdir.cleanup()
+
+    for stage in stages.values():
+        stage['rows_per_s'] = stage['rows'] / stage['seconds'] if stage['seconds'] else None
+        stage['requests_per_s'] = stage['requests'] / stage['seconds'] if stage['seconds'] else None
+    return {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'parameters': {'years': list(years), 'opstinas': opstinas, 'kat_opstinas': kat_opstinas,
+                       'contracts': contracts, 'objects': objects, 'katastar_latency': katastar_latency,
+                       'nominatim_latency': nominatim_latency, 'error_rate': error_rate,
+                       'max_concurrency': max_concurrency, 'rate_limit': rate_limit},
+        'rows': rows,
+        'total_seconds': total,
+        'peak_rss_mb': peak_rss_mb(),
+        'katastar': {'requests': katastar.requests, 'errors': katastar.errors, 'bytes': katastar.bytes_sent},
+        'nominatim': {'requests': nominatim.requests, 'errors': nominatim.errors},
+        'stages': stages,
+    }
+
+
+def print_report(result, previous=None):
+    """
+    Print per-stage times and throughput, compared with a previous result of the same parameters if given.
+    """
+    peak_rss = 'n/a' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f} MB"
+    print(f"\n{result['rows']} rows in {result['total_seconds']:.1f}s, peak RSS {peak_rss}")
+    print(f"{'stage':<10}{'seconds':>10}{'rows/s':>12}{'req/s':>10}{'vs previous':>14}")
+    for name, stage in result['stages'].items():
+        change = ''
+        if previous is not None and name in previous['stages'] and previous['stages'][name]['seconds']:
+            change = f"{stage['seconds'] / previous['stages'][name]['seconds'] * 100 - 100:+.0f}% time"
+        print(f"{name:<10}{stage['seconds']:>10.2f}{stage['rows_per_s'] or 0:>12.0f}"
+              f"{stage['requests_per_s'] or 0:>10.1f}{change:>14}")
+
+
+def latest_result(folder, parameters):
+    """
+    :return: dict, the newest saved result with the same parameters, or None
+    """
+    for path in sorted(Path(folder).glob('benchmark_*.json'), reverse=True):
+        with open(path, encoding='utf-8') as f:
+            result = json.load(f)
+        if result['parameters'] == parameters:
+            return result
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark scrape, parse, geocode and export against local '
+                                                 'fake katastar and Nominatim servers')
+    parser.add_argument('--years', type=int, nargs='+', default=[2023])
+    parser.add_argument('--opstinas', type=int, default=10)
+    parser.add_argument('--kat-opstinas', type=int, default=5, help='KOs per opstina')
+    parser.add_argument('--contracts', type=int, default=50, help='contracts per KO and year')
+    parser.add_argument('--objects', type=int, default=2, help='objects per contract')
+    parser.add_argument('--katastar-latency', type=float, default=0.05, help='seconds added to every response')
+    parser.add_argument('--nominatim-latency', type=float, default=0.02, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--max-concurrency', type=int, default=COLLECT_MAX_CONCURRENCY)
+    parser.add_argument('--rate-limit', type=float, default=COLLECT_RATE_LIMIT,
+                        help='katastar requests per second, 0 for no limit')
+    parser.add_argument('--output', type=Path, default=BENCHMARK_FOLDER, help='folder of the result JSON files')
+    args = parser.parse_args()
+
+    result = run_benchmark(args.years, args.opstinas, args.kat_opstinas, args.contracts, args.objects,
+                           args.katastar_latency, args.nominatim_latency, args.error_rate, args.max_concurrency,
+                           args.rate_limit)
+    print_report(result, latest_result(args.output, result['parameters']))
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    output_file = args.output.joinpath(f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    print(f'Results saved to {output_file}')
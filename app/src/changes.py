@@ -0,0 +1,117 @@
+import os
+import json
+import logging
+import threading
+
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from constants import CHANGES_FOLDER, CHANGES_FORMATS, CONTRACT_KEY
+from geo_and_xlsx_conversion import GEO_COLUMNS, APPROXIMATED_COLUMN
+from storage import CONTRACTS_SCHEMA, GEOCODED_SCHEMA, conform
+
+CHANGE_COLUMN = 'change'
+NEW, CHANGED, REMOVED = 'new', 'changed', 'removed'
+
+# a delta row: the kind of change, the partition, and the contract with its address columns.
+# Removed rows carry the values they had in the previous snapshot.
+CHANGES_SCHEMA = pa.schema(
+    [(CHANGE_COLUMN, pa.string()), ('year', pa.int64()), ('opstina', pa.string())] + list(CONTRACTS_SCHEMA)
+    + [GEOCODED_SCHEMA.field(column) for column in GEO_COLUMNS + [APPROXIMATED_COLUMN]]
+)
+
+
+def mark_changes(df, change, opst):
+    """
+    :return: pd.DataFrame, contracts rows with the change and opstina columns set
+    """
+    return df.assign(**{CHANGE_COLUMN: change, 'opstina': opst})
+
+
+class ChangeLog:
+    """
+    Delta files of the runs which modify the store: changes_<run>.parquet / .csv with the new, changed and
+    removed contracts of a year compared with its previous snapshot, listed in manifest.json.
+    Consumers apply the deltas in manifest order; each entry names the run before it.
+    The backfill of collect_old_data isn't recorded: the first delta is relative to the store it left.
+    """
+
+    def __init__(self, folder=CHANGES_FOLDER, formats=CHANGES_FORMATS):
+        self.folder = Path(folder)
+        self.formats = formats
+        self.manifest_path = self.folder.joinpath('manifest.json')
+        self._lock = threading.Lock()
+
+    def entries(self):
+        """
+        :return: list of dict, manifest entries oldest first
+        """
+        if not self.manifest_path.exists():
+            return []
+        return json.loads(self.manifest_path.read_text(encoding='utf-8'))
+
+    @staticmethod
+    def with_addresses(changes_df, year, store):
+        """
+        Join the address columns stored for the changed rows.
+        """
+        frames = []
+        for opst, opstina_df in changes_df.groupby('opstina', sort=True):
+            geocoded_df = store.read_partition('geocoded', year, opst).drop_duplicates(subset=CONTRACT_KEY, keep='last')
+            frames.append(opstina_df.merge(geocoded_df, on=CONTRACT_KEY, how='left'))
+        return pd.concat(frames, ignore_index=True) if frames else changes_df
+
+    def write(self, year, frames, store):
+        """
+        Write the delta files of a run and add them to the manifest.
+
+        :param year: int
+        :param frames: list of pd.DataFrame, contracts rows with the change and opstina columns (see mark_changes)
+        :param store: ContractStore, source of the address columns
+        :return: dict, the manifest entry, or None if no formats are configured
+        """
+        if not self.formats:
+            return None
+        frames = [df for df in frames if not df.empty]
+        changes_df = pd.concat(frames, ignore_index=True) if frames else CHANGES_SCHEMA.empty_table().to_pandas()
+        changes_df = self.with_addresses(changes_df.assign(year=year), year, store)
+        table = conform(changes_df, CHANGES_SCHEMA)
+
+        created_at = datetime.now()
+        run = f"{created_at.strftime('%Y%m%dT%H%M%S')}_{year}"
+        self.folder.mkdir(parents=True, exist_ok=True)
+        files = {}
+        for file_format in self.formats:
+            path = self.folder.joinpath(f'changes_{run}.{file_format}')
+            tmp_path = path.with_name(path.name + '.tmp')
+            if file_format == 'parquet':
+                pq.write_table(table, tmp_path)
+            else:
+                table.to_pandas().to_csv(tmp_path, index=False, encoding='utf-8')
+            os.replace(tmp_path, path)
+            files[file_format] = path.name
+
+        counts = changes_df[CHANGE_COLUMN].value_counts()
+        with self._lock:
+            entries = self.entries()
+            entry = {
+                'run': run,
+                'created_at': created_at.isoformat(timespec='seconds'),
+                'year': year,
+                'previous': entries[-1]['run'] if entries else None,
+                'rows': {change: int(counts.get(change, 0)) for change in (NEW, CHANGED, REMOVED)},
+                'files': files,
+            }
+            tmp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+            tmp_path.write_text(json.dumps(entries + [entry], indent=1), encoding='utf-8')
+            os.replace(tmp_path, self.manifest_path)
+
+        stats_msg = f"{year} changes: {entry['rows'][NEW]} new, {entry['rows'][CHANGED]} changed, " \
+                    f"{entry['rows'][REMOVED]} removed -> {', '.join(files.values())}"
+        print(stats_msg)
+        logging.info(stats_msg)
+        return entry
@@ -0,0 +1,212 @@
+import time
+import asyncio
+import logging
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from constants import COLLECT_MAX_CONCURRENCY, COLLECT_RATE_LIMIT, SHARD_MIN_DAYS, GEOCODE_INITIAL_CONCURRENCY, \
+    GEOCODE_MIN_CONCURRENCY, GEOCODE_MAX_CONCURRENCY, GEOCODE_TARGET_LATENCY
+
+# one Default.aspx/Data request: contracts of a katastarska opstina in a date window
+CollectTask = namedtuple('CollectTask', ['year', 'opstina', 'kat_opstina', 'start_date', 'finish_date'])
+
+DATE_FORMAT = '%d.%m.%Y'
+
+
+def window_days(start_date, finish_date):
+    """
+    :return: int, number of days in the window, both ends included
+    """
+    return (datetime.strptime(finish_date, DATE_FORMAT) - datetime.strptime(start_date, DATE_FORMAT)).days + 1
+
+
+def split_window(start_date, finish_date, max_days):
+    """
+    Split a 'dd.mm.yyyy' date window into consecutive windows of at most max_days days.
+
+    :return: list of (str, str)
+    """
+    start = datetime.strptime(start_date, DATE_FORMAT)
+    finish = datetime.strptime(finish_date, DATE_FORMAT)
+    max_days = max(1, int(max_days))
+    windows = []
+    while start <= finish:
+        end = min(finish, start + timedelta(days=max_days - 1))
+        windows.append((start.strftime(DATE_FORMAT), end.strftime(DATE_FORMAT)))
+        start = end + timedelta(days=1)
+    return windows
+
+
+def halve_task(task, min_days=SHARD_MIN_DAYS):
+    """
+    Split the task's window in two halves.
+
+    :return: list of CollectTask, empty if the window is already min_days or shorter
+    """
+    days = window_days(task.start_date, task.finish_date)
+    if days <= min_days:
+        return []
+    return [task._replace(start_date=start, finish_date=finish)
+            for start, finish in split_window(task.start_date, task.finish_date, (days + 1) // 2)]
+
+
+class RateLimiter:
+    """
+    Spaces requests evenly so that no more than `rate` requests per second are started.
+    It is thread-safe, so it may be shared by several event loops.
+    """
+
+    def __init__(self, rate=COLLECT_RATE_LIMIT):
+        self.interval = 1 / rate if rate else 0
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Reserve the next free slot and return how long to wait for it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        return slot - now
+
+    async def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class AimdLimiter:
+    """
+    Limit on requests in flight that adapts to the server: additive increase (about +1 per limit's worth
+    of fast successful requests), multiplicative decrease on an error or a response slower than target_latency.
+    Only requests started after the last decrease can decrease it again, so one burst of failures of
+    requests sent together halves the limit once. It is thread-safe.
+    """
+
+    def __init__(self, initial=GEOCODE_INITIAL_CONCURRENCY, min_limit=GEOCODE_MIN_CONCURRENCY,
+                 max_limit=GEOCODE_MAX_CONCURRENCY, target_latency=GEOCODE_TARGET_LATENCY, decrease_factor=0.5):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+        self.decreases = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Block until a request may start.
+
+        :return: float, start time to pass to release()
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, ok=True):
+        """
+        Record the outcome of a request started by acquire() and adapt the limit.
+        """
+        latency = time.monotonic() - started
+        with self._condition:
+            self.in_flight -= 1
+            if ok:
+                self.successes += 1
+            else:
+                self.failures += 1
+            if ok and latency <= self.target_latency:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif started >= self._last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self._last_decrease = time.monotonic()
+                self.decreases += 1
+            self._condition.notify_all()
+
+    def log_stats(self, label=''):
+        stats_msg = f"{label}Concurrency limit {int(self.limit)} ({self.min_limit}-{self.max_limit}), " \
+                    f"requests ok {self.successes}, failed {self.failures}, decreases {self.decreases}"
+        print(stats_msg)
+        logging.info(stats_msg)
+
+
+class CollectionEngine:
+    """
+    Runs a flat list of tasks on asyncio with a bounded number of requests in flight and a requests-per-second cap.
+
+    `fetch(task)` is a blocking call (an HTTP request plus parsing) executed in a worker thread.
+    `on_result(task, result)` is called in the event loop thread as soon as a task finishes, one at a time,
+    so it can write results to storage without extra locking. `on_error(task, exception)` is called
+    the same way for tasks that failed. Both may return new tasks (e.g. shards of a failed window),
+    which are queued on the same engine; a failed task that is replaced this way isn't reported as failed.
+    """
+
+    def __init__(self, max_concurrency=COLLECT_MAX_CONCURRENCY, rate_limit=COLLECT_RATE_LIMIT):
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(rate_limit)
+
+    def run(self, tasks, fetch, on_result=None, on_error=None):
+        """
+        Process all tasks and return the list of tasks that failed.
+        """
+        tasks = list(tasks)
+        if not tasks:
+            return []
+        return asyncio.run(self._run(tasks, fetch, on_result, on_error))
+
+    async def _run(self, tasks, fetch, on_result, on_error):
+        queue = asyncio.Queue()
+        for task in tasks:
+            queue.put_nowait(task)
+
+        failed = []
+        n_workers = min(self.max_concurrency, len(tasks))
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            workers = [asyncio.create_task(self._worker(queue, fetch, on_result, on_error, failed, executor))
+                       for _ in range(n_workers)]
+            all_done = asyncio.create_task(queue.join())
+            await asyncio.wait([all_done, *workers], return_when=asyncio.FIRST_COMPLETED)
+            for worker in workers:
+                worker.cancel()
+            # workers only stop by themselves when a callback raised
+            for worker in workers:
+                if worker.done() and not worker.cancelled() and worker.exception() is not None:
+                    all_done.cancel()
+                    raise worker.exception()
+
+        if failed:
+            print(f'{len(failed)}/{len(tasks)} tasks failed')
+            logging.info(f'{len(failed)}/{len(tasks)} tasks failed')
+        return failed
+
+    async def _worker(self, queue, fetch, on_result, on_error, failed, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            task = await queue.get()
+            try:
+                await self.rate_limiter.wait()
+                try:
+                    result = await loop.run_in_executor(executor, fetch, task)
+                except Exception as e:
+                    print(f'Task {task} failed: {e}')
+                    logging.info(f'Task {task} failed: {e}')
+                    new_tasks = on_error(task, e) if on_error is not None else None
+                    if not new_tasks:
+                        failed.append(task)
+                else:
+                    new_tasks = on_result(task, result) if on_result is not None else None
+                for new_task in new_tasks or []:
+                    queue.put_nowait(new_task)
+            finally:
+                queue.task_done()
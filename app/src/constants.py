@@ -1,6 +1,8 @@
 from pathlib import Path
 
 BASE_URL = 'https://katastar.rgz.gov.rs/RegistarCenaNepokretnosti/'
+# self-hosted Nominatim used for reverse geocoding
+NOMINATIM_URL = 'http://localhost:8080'
 
 DEFAULT_HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; rv:121.0) Gecko/20100101 Firefox/121.0',
@@ -27,3 +29,113 @@ REPLACE_DICT = {'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'ђ': 'đ
                 'ј': 'j', 'к': 'k', 'л': 'l', 'љ': 'lj', 'м': 'm', 'н': 'n', 'њ': 'nj', 'о': 'o', 'п': 'p', 'р': 'r',
                 'с': 's', 'т': 't', 'ћ': 'ć', 'ч': 'č', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c', 'џ': 'dž', 'ш': 'š', ' ': ' '}
 
+
+CACHE_FOLDER = Path("../data/cache")
+GEOCODE_CACHE_PATH = CACHE_FOLDER.joinpath("geocode_cache.sqlite")
+# cached addresses are re-queried after half a year
+GEOCODE_CACHE_TTL = 180 * 24 * 60 * 60
+GEOCODE_CACHE_MAX_ENTRIES = 2_000_000
+# 6 decimal places is ~0.1 m, finer than the precision of katastar coordinates
+GEOCODE_CACHE_PRECISION = 6
+# seconds to wait for another connection's write transaction on the cache
+GEOCODE_CACHE_BUSY_TIMEOUT = 30
+# coordinates closer than this many meters to an already geocoded point reuse its address (0 disables)
+GEOCODE_PROXIMITY_RADIUS = 10
+# latitude at which the proximity index's grid cells are square (Serbia spans 42-46.2 N)
+GEOCODE_PROXIMITY_REFERENCE_LAT = 44
+
+# shared HTTP client: (connect, read) timeouts in seconds, retries with jittered exponential backoff
+HTTP_TIMEOUT = (10, 120)
+HTTP_MAX_RETRIES = 5
+HTTP_BACKOFF_BASE = 1
+HTTP_BACKOFF_MAX = 60
+HTTP_POOL_SIZE = 32
+
+# collection engine: parallel katastar requests in flight and the global requests-per-second cap
+COLLECT_MAX_CONCURRENCY = 8
+COLLECT_RATE_LIMIT = 5
+
+# geocoding: Nominatim requests in flight adapt between min and max (AIMD on latency and errors)
+GEOCODE_INITIAL_CONCURRENCY = 2
+GEOCODE_MIN_CONCURRENCY = 1
+GEOCODE_MAX_CONCURRENCY = 16
+# slower responses count as congestion, seconds
+GEOCODE_TARGET_LATENCY = 1.0
+# failed coordinates are retried in rounds after GEOCODE_RETRY_BACKOFF * 2^round seconds
+GEOCODE_RETRY_ROUNDS = 3
+GEOCODE_RETRY_BACKOFF = 5
+
+STATE_FOLDER = Path("../data/state")
+WATERMARK_PATH = STATE_FOLDER.joinpath("watermarks.sqlite")
+# weekly updates re-query this many days before the last seen contract date to catch late registrations
+UPDATE_OVERLAP_DAYS = 14
+
+# a row of the contracts data is one object of one contract
+CONTRACT_KEY = ['contract ID', 'object ID']
+
+# columnar store: <PARQUET_FOLDER>/<dataset>/year=<year>/opstina=<opstina>/part-0.parquet
+PARQUET_FOLDER = Path("../data/parquet")
+# contracts_<year>.csv and contracts_<year>_with_location.xlsx written before the store are imported once
+# into this partition of their year (they have no opstina column)
+LEGACY_OPSTINA = 'legacy'
+LEGACY_IMPORT_MARKER = STATE_FOLDER.joinpath("legacy_imported")
+# render the consolidated contracts.xlsx after each run
+EXPORT_XLSX = True
+MANIFEST_PATH = STATE_FOLDER.joinpath("manifest.sqlite")
+# (contract ID, object ID) of every stored row with a fingerprint of its values
+SEEN_KEYS_PATH = STATE_FOLDER.joinpath("seen_keys.sqlite")
+
+# form metadata of the landing page (opstina list, filters, ViewState) and KO lists per opstina
+METADATA_PATH = STATE_FOLDER.joinpath("metadata.json")
+METADATA_TTL = 7 * 24 * 60 * 60
+KAT_OPSTINA_TTL = 30 * 24 * 60 * 60
+
+# adaptive date-window sharding of Default.aspx/Data requests
+SHARD_MAX_RESPONSE_BYTES = 10 * 1024 * 1024
+SHARD_MAX_LATENCY = 30
+SHARD_MIN_DAYS = 7
+# a sharded KO whose responses stay under this fraction of both limits gets its window doubled
+SHARD_GROW_RATIO = 0.5
+
+# compressed raw katastar and Nominatim responses, used for offline replay
+ARCHIVE_FOLDER = Path("../data/archive")
+ARCHIVE_RESPONSES = True
+
+# administrative boundaries (GeoJSON, e.g. an OSM boundary export) for the offline municipality resolver
+ADMIN_BOUNDARIES_PATH = Path("../data/boundaries/serbia_admin.geojson")
+ADMIN_LEVEL_PROPERTY = 'admin_level'
+ADMIN_NAME_PROPERTY = 'name'
+# OSM admin_level of Serbian boundaries -> address column
+ADMIN_LEVELS = {'2': 'country', '4': 'state', '6': 'county', '7': 'municipality'}
+# grid cell of the boundary index, degrees
+ADMIN_GRID_SIZE = 0.05
+# query Nominatim for street/house number when boundaries are available; if False admin columns only
+GEOCODE_STREET_DETAIL = True
+
+# pipelined geocoding: geocoded partitions waiting to be written
+PIPELINE_QUEUE_SIZE = 4
+
+# results of benchmark.py, one JSON file per run
+BENCHMARK_FOLDER = Path("../data/benchmarks")
+
+# metrics snapshots (JSON and Prometheus textfile), written after every run and periodically during it
+METRICS_FOLDER = Path("../data/metrics")
+METRICS_INTERVAL = 60
+# stages profiled with cProfile into METRICS_FOLDER/profile_<stage>.prof, e.g. {'parse', 'geocode', 'export'}
+PROFILE_STAGES = set()
+
+# job runner of the service: jobs running at once, and the folder polled for on-demand triggers (app.py --year)
+JOB_WORKERS = 2
+TRIGGER_FOLDER = Path("../data/triggers")
+
+# SQLite query index over the complete years of the store (query.py), refreshed after each run
+QUERY_INDEX = True
+QUERY_INDEX_PATH = OUTPUT_FOLDER.joinpath("contracts.sqlite")
+# rows returned by a contracts query unless a limit is given
+QUERY_LIMIT = 1000
+QUERY_PORT = 8090
+
+# change data capture: new, changed and removed contracts of every update run, as delta files with a manifest
+CHANGES_FOLDER = OUTPUT_FOLDER.joinpath("changes")
+# formats of the delta files, nothing is written if empty
+CHANGES_FORMATS = ('parquet', 'csv')
@@ -0,0 +1,70 @@
+import os
+
+import xlsxwriter
+
+# rows per worksheet including the header
+EXCEL_MAX_ROWS = 1_048_576
+
+
+def write_xlsx(sheets, output_file, max_rows=EXCEL_MAX_ROWS):
+    """
+    Stream DataFrames into an XLSX workbook in xlsxwriter's constant_memory mode.
+    Only the current row is held in memory. A sheet that reaches Excel's row limit
+    is continued on '<name>_2', '<name>_3', ...
+
+    :param sheets: iterable of (sheet name, iterable of pd.DataFrame with the same columns)
+    :param output_file: path of the workbook
+    :param max_rows: int, rows per worksheet including the header
+    :return: int, number of data rows written
+    """
+    workbook = xlsxwriter.Workbook(str(output_file), {
+        'constant_memory': True,
+        'strings_to_numbers': False,
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+        'default_date_format': 'dd.mm.yyyy',
+    })
+    total_rows = 0
+    try:
+        for sheet_name, frames in sheets:
+            worksheet, header, sheet_counter, row_idx = None, None, 0, 0
+            for df in frames:
+                if header is None:
+                    header = list(df.columns)
+                values = df.astype(object).where(df.notna(), None)
+                for row in values.itertuples(index=False, name=None):
+                    if worksheet is None or row_idx == max_rows:
+                        sheet_counter += 1
+                        name = sheet_name if sheet_counter == 1 else f"{sheet_name}_{sheet_counter}"
+                        worksheet = workbook.add_worksheet(name)
+                        worksheet.write_row(0, 0, header)
+                        row_idx = 1
+                    worksheet.write_row(row_idx, 0, row)
+                    row_idx += 1
+                total_rows += len(df)
+
+            # keep empty sheets with just the header
+            if worksheet is None:
+                worksheet = workbook.add_worksheet(sheet_name)
+                if header is not None:
+                    worksheet.write_row(0, 0, header)
+    finally:
+        workbook.close()
+    return total_rows
+
+
+def export_store(store, output_file):
+    """
+    Render geocoded contracts of all complete years of a ContractStore into one workbook, one sheet per year.
+    Rows are streamed from the store, so memory is bounded by one opstina partition.
+
+    :return: int, number of data rows written
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    print('Creating result file')
+    sheets = ((f"{year}", store.iter_year_geocoded(year)) for year in store.years())
+    rows = write_xlsx(sheets, output_file)
+    print(f'Result file has been created: {rows} items')
+    return rows
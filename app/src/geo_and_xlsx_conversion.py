@@ -1,19 +1,42 @@
 import time
 
+import json
 import pandas as pd
 import requests
 import os
 import logging
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
 
+from collector import AimdLimiter
+from constants import CONTRACT_KEY, GEOCODE_STREET_DETAIL, GEOCODE_MAX_CONCURRENCY, GEOCODE_RETRY_ROUNDS, \
+    GEOCODE_RETRY_BACKOFF
+from export import write_xlsx
+from geocode_cache import GeocodeCache
+from http_client import get_client
+from metrics import get_metrics
+from proximity_index import ProximityIndex
 
-def reverse_geocode(lat, lon, server_url="http://localhost:8080", language="sr-Latn"):
+
+# address columns added to every row, in output order
+GEO_COLUMNS = ["display_name", "house_number", "road", "village", "municipality", "county", "state", "postcode",
+               "country"]
+# True where the address was taken from a geocoded point nearby instead of querying the coordinates themselves
+APPROXIMATED_COLUMN = "approximated"
+
+
+def reverse_geocode(lat, lon, server_url="http://localhost:8080", language="sr-Latn", cache=None, archive=None,
+                    retries=2):
     """
-    Query the Nominatim server for detailed address components.
+    Query the Nominatim server for detailed address components, retrying transient HTTP failures `retries` times.
+    If a GeocodeCache is given, known coordinates are answered from it and new results are stored in it.
+    Raw responses are kept in the ResponseArchive if one is given; an offline archive replaces the server.
     """
+    if cache is not None:
+        cached = cache.get(lat, lon)
+        if cached is not None:
+            return cached
+
     endpoint = f"{server_url}/reverse"
     params = {
         "lat": lat,
@@ -25,26 +48,33 @@ def reverse_geocode(lat, lon, server_url="http://localhost:8080", language="sr-L
     }
     
     try:
-        response = requests.get(endpoint, params=params, timeout=5)
-        response.raise_for_status()
-        response.encoding = 'utf-8'
-        data = response.json()
-        return {
+        if archive is not None and archive.offline:
+            text = archive.get("nominatim", params)
+            if text is None:
+                raise LookupError("not in the archive")
+            data = json.loads(text)
+        else:
+            response = get_client().get(endpoint, params=params, timeout=5, retries=retries,
+                                        endpoint='reverse')
+            response.encoding = 'utf-8'
+            data = response.json()
+            if archive is not None:
+                archive.put("nominatim", params, response.text)
+        address_data = {
             "display_name": data.get("display_name", "Unknown address"),
             "address": data.get("address", {})
         }
+        if cache is not None:
+            cache.put(lat, lon, address_data)
+        return address_data
+    except LookupError:
+        # not archived: geocode_coordinates falls back to a neighbour, replay reports what is left
+        return {"display_name": "Error", "address": {}}
     except requests.exceptions.RequestException as e:
         print(f"Error for ({lat}, {lon}): {e}")
         return {"display_name": "Error", "address": {}}
 
 
-def process_row(row, lat_col, lon_col, server_url):
-    """Helper function to process a single row."""
-    lat = row[lat_col]
-    lon = row[lon_col]
-    return (lat, lon, reverse_geocode(lat, lon, server_url))
-
-
 def parse_address(address_data):
     """
     Parse Nominatim’s detailed address components into OpenStreetMap-style columns.
@@ -86,7 +116,157 @@ def parse_address(address_data):
     return parsed
 
 
-def process_csv(input_file, output_file, server_url="http://localhost:8080", max_workers=4):
+def geocode_coordinates(lat_values, lon_values, server_url="http://localhost:8080", max_workers=None, cache=None,
+                        label='', archive=None, resolver=None, street_detail=GEOCODE_STREET_DETAIL, proximity=None,
+                        limiter=None):
+    """
+    Reverse geocode coordinate columns, querying each distinct (lat, lon) pair only once.
+    Returns a DataFrame with GEO_COLUMNS and APPROXIMATED_COLUMN aligned to the index of the input columns;
+    rows with missing or non-numeric coordinates get empty values.
+    Requests in flight are bounded by an AimdLimiter (a new one up to max_workers if none is given),
+    and failed coordinates are retried in rounds with exponential backoff.
+    With a ProximityIndex, coordinates within its radius of an already geocoded point reuse that point's address;
+    with an offline archive, only coordinates which aren't archived do (the run which archived them didn't query them).
+    With an AdminResolver the administrative columns come from the local boundaries and override Nominatim;
+    if street_detail is False, Nominatim isn't queried at all.
+    """
+    coords = pd.DataFrame({
+        "lat": pd.to_numeric(lat_values, errors='coerce'),
+        "lon": pd.to_numeric(lon_values, errors='coerce'),
+    })
+    unique_coords = coords.dropna().drop_duplicates()
+    query_server = resolver is None or street_detail
+    print(f"{label}: geocoding {len(unique_coords)} unique coordinates for {len(coords)} rows")
+    logging.info(f"{label}: geocoding {len(unique_coords)} unique coordinates for {len(coords)} rows")
+
+    # (lat, lon) -> address data, and coordinates answered by a neighbour -> the neighbour's coordinates
+    address_by_coords = {}
+    neighbours = {}
+    to_query = []
+    # points are added to the proximity index once they are geocoded; until then a neighbour of a point
+    # queried in this call waits for its answer
+    queried = ProximityIndex(proximity.radius) if proximity is not None else None
+    offline = archive is not None and archive.offline
+    for lat, lon in (unique_coords.itertuples(index=False, name=None) if query_server else []):
+        cached = cache.get(lat, lon) if cache is not None else None
+        if cached is not None:
+            address_by_coords[(lat, lon)] = cached
+            continue
+        if proximity is not None and not offline:
+            neighbour = proximity.nearest(lat, lon) or queried.nearest(lat, lon)
+            if neighbour is not None:
+                neighbours[(lat, lon)] = neighbour
+                continue
+            queried.add(lat, lon)
+        to_query.append((lat, lon))
+    metrics = get_metrics()
+    metrics.inc('geocode_coordinates_total', len(address_by_coords), source='cache')
+
+    if limiter is None:
+        limiter = AimdLimiter(max_limit=max_workers or GEOCODE_MAX_CONCURRENCY)
+
+    def limited_reverse_geocode(lat, lon):
+        # failures go to the retry rounds below instead of being retried while holding a slot
+        started = limiter.acquire()
+        address_data = {"display_name": "Error", "address": {}}
+        try:
+            address_data = reverse_geocode(lat, lon, server_url, archive=archive, retries=0)
+        finally:
+            limiter.release(started, ok=address_data["display_name"] != "Error")
+        return address_data
+
+    def query(to_query, retry_rounds):
+        """
+        :return: list of (float, float), coordinates which still fail after the retry rounds
+        """
+        with ThreadPoolExecutor(max_workers=limiter.max_limit) as executor:
+            for retry_round in range(retry_rounds + 1):
+                if retry_round:
+                    delay = GEOCODE_RETRY_BACKOFF * 2 ** (retry_round - 1)
+                    print(f"{label}: retrying {len(to_query)} failed coordinates in {delay}s "
+                          f"(round {retry_round}/{retry_rounds})")
+                    logging.info(f"{label}: retrying {len(to_query)} failed coordinates in {delay}s")
+                    metrics.inc('geocode_retries_total', len(to_query))
+                    time.sleep(delay)
+
+                future_to_coords = {executor.submit(limited_reverse_geocode, lat, lon): (lat, lon)
+                                    for lat, lon in to_query}
+                failed = []
+                for future in as_completed(future_to_coords):
+                    lat, lon = future_to_coords[future]
+                    try:
+                        address_data = future.result()
+                    except Exception as e:
+                        print(f"Error for ({lat}, {lon}) in {label}: {e}")
+                        address_data = {"display_name": "Error", "address": {}}
+                    if address_data["display_name"] == "Error":
+                        failed.append((lat, lon))
+                    else:
+                        if cache is not None:
+                            cache.put(lat, lon, address_data)
+                        if proximity is not None:
+                            proximity.add(lat, lon, address_data)
+                    address_by_coords[(lat, lon)] = address_data
+                to_query = failed
+                metrics.set('geocode_concurrency_limit', limiter.limit)
+                if not to_query:
+                    break
+        return to_query
+
+    # an offline archive answers the same way every time, so retrying is pointless
+    retry_rounds = 0 if offline else GEOCODE_RETRY_ROUNDS
+    queried_count = len(to_query)
+    failed = query(to_query, retry_rounds)
+    # neighbours of points which failed are queried themselves, once
+    failed_coords = set(failed)
+    orphans = [point for point, neighbour in neighbours.items() if neighbour in failed_coords]
+    if orphans:
+        for point in orphans:
+            del neighbours[point]
+        queried_count += len(orphans)
+        failed += query(orphans, 0)
+    if offline and proximity is not None:
+        # coordinates answered by a neighbour when the archive was written were never queried
+        for point in failed:
+            neighbour = proximity.nearest(*point)
+            if neighbour is not None:
+                neighbours[point] = neighbour
+                del address_by_coords[point]
+        failed = [point for point in failed if point not in neighbours]
+    if proximity is not None:
+        proximity.saved += len(neighbours)
+    metrics.inc('geocode_coordinates_total', len(neighbours), source='proximity')
+    metrics.inc('geocode_coordinates_total', queried_count, source='nominatim')
+    metrics.inc('geocode_failures_total', len(failed))
+
+    results = []
+    for (lat, lon), address_data in address_by_coords.items():
+        results.append({"lat": lat, "lon": lon, "display_name": address_data["display_name"],
+                        **parse_address(address_data), APPROXIMATED_COLUMN: False})
+    for (lat, lon), neighbour in neighbours.items():
+        address_data = address_by_coords.get(neighbour) or proximity.address(*neighbour)
+        address_data = address_data or {"display_name": "Error", "address": {}}
+        results.append({"lat": lat, "lon": lon, "display_name": address_data["display_name"],
+                        **parse_address(address_data), APPROXIMATED_COLUMN: True})
+    if proximity is not None:
+        proximity.log_stats(f"{label}: ", saved=len(neighbours))
+
+    geo_df = pd.DataFrame(results, columns=["lat", "lon", *GEO_COLUMNS, APPROXIMATED_COLUMN])
+    if resolver is not None:
+        geo_df = unique_coords.merge(geo_df, on=["lat", "lon"], how='left')
+        geo_df[APPROXIMATED_COLUMN] = geo_df[APPROXIMATED_COLUMN].fillna(False)
+        admin_df = resolver.resolve(geo_df["lat"], geo_df["lon"])
+        if not query_server:
+            admin_df.loc[admin_df.notna().any(axis=1), "country"] = admin_df["country"].fillna("Srbija")
+        for column in admin_df.columns:
+            geo_df[column] = admin_df[column].where(admin_df[column].notna(), geo_df[column])
+    geo_df = coords.merge(geo_df, on=["lat", "lon"], how='left')[[*GEO_COLUMNS, APPROXIMATED_COLUMN]]
+    geo_df.index = coords.index
+    return geo_df.astype(object).where(geo_df.notna(), None)
+
+
+def process_csv(input_file, output_file, server_url="http://localhost:8080", max_workers=None, cache=None,
+                archive=None, proximity=None, limiter=None):
     """
     Read a CSV, reverse geocode coordinates, parse addresses, and save to XLSX with minimal formatting.
     """
@@ -102,41 +282,12 @@ def process_csv(input_file, output_file, server_url="http://localhost:8080", max
         print(f"Skipping {input_file}: CSV must contain 'latitude' and 'longitude' columns")
         return
     
-    # Initialize columns with Nominatim-style names
-    df["display_name"] = None
-    df["house_number"] = None
-    df["road"] = None
-    df["village"] = None
-    df["municipality"] = None
-    df["county"] = None
-    df["state"] = None
-    df["postcode"] = None
-    df["country"] = None
-    
-    # Filter out rows with NaN or invalid lat/lon values
-    valid_rows = df.dropna(subset=[lat_col, lon_col])
-    valid_rows = valid_rows[valid_rows[lat_col].apply(pd.to_numeric, errors='coerce').notna()]
-    valid_rows = valid_rows[valid_rows[lon_col].apply(pd.to_numeric, errors='coerce').notna()]
-    
-    # Process only valid rows in parallel
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_coords = {
-            executor.submit(process_row, row, lat_col, lon_col, server_url): index
-            for index, row in valid_rows.iterrows()
-        }
-        for future in as_completed(future_to_coords):
-            index = future_to_coords[future]
-            try:
-                lat, lon, address_data = future.result()
-                df.at[index, "display_name"] = address_data["display_name"]
-                parsed = parse_address(address_data)
-                for key, value in parsed.items():
-                    df.at[index, key] = value
-                print(f"Processed row {index} in {os.path.basename(input_file)}: ({lat}, {lon})")
-            except Exception as e:
-                print(f"Error at index {index} in {os.path.basename(input_file)}: {e}")
-                df.at[index, "display_name"] = "Error"
-    
+    # Geocode each distinct coordinate pair once and join the address columns back to all rows
+    geo_df = geocode_coordinates(df[lat_col], df[lon_col], server_url, max_workers, cache,
+                                 label=os.path.basename(input_file), archive=archive, proximity=proximity,
+                                 limiter=limiter)
+    df = pd.concat([df.drop(columns=[*GEO_COLUMNS, APPROXIMATED_COLUMN], errors='ignore'), geo_df], axis=1)
+
     # Calculate error statistics
     total_rows = len(df)
     error_count = len(df[df["display_name"] == "Error"])
@@ -146,33 +297,37 @@ def process_csv(input_file, output_file, server_url="http://localhost:8080", max
     error_msg = f"{os.path.basename(input_file)}: Errors: {error_count}/{total_rows} ({error_percentage:.2f}%)"
     print(error_msg)
     logging.info(error_msg)
+    if cache is not None:
+        cache.log_stats(f"{os.path.basename(input_file)}: ")
     
-    # Save to XLSX with minimal formatting
-    wb = Workbook()
-    ws = wb.active
-    for r in dataframe_to_rows(df, index=False, header=True):
-        ws.append(r)
-    
-    wb.save(output_file)
+    save_xlsx(df, output_file)
+
+
+def save_xlsx(df, output_file):
+    """
+    Save a DataFrame to XLSX with minimal formatting.
+    """
+    write_xlsx([("Sheet", [df])], output_file)
     print(f"Results saved to {output_file}")
 
 
-def process_folder(input_folder, output_folder, server_url="http://localhost:8080", max_workers=4):
+def geocode_contracts(contracts_df, server_url="http://localhost:8080", max_workers=None, cache=None, label='',
+                      archive=None, resolver=None, proximity=None, limiter=None):
     """
-    Process all CSV files in a folder and save results to an output folder.
+    Geocode contracts and return their address columns keyed by CONTRACT_KEY.
     """
+    geo_df = geocode_coordinates(contracts_df["latitude"], contracts_df["longitude"], server_url, max_workers, cache,
+                                 label=label, archive=archive, resolver=resolver, proximity=proximity,
+                                 limiter=limiter)
+    return pd.concat([contracts_df[CONTRACT_KEY], geo_df], axis=1)
 
-    # server_url = 'https://nominatim.openstreetmap.org'
-    # Ensure input folder exists
-    if not os.path.isdir(input_folder):
-        raise ValueError(f"{input_folder} is not a valid directory")
 
-    # Create output folder and log subfolder
-    os.makedirs(output_folder, exist_ok=True)
+def setup_logging(output_folder):
+    """
+    Log to a timestamped file in the "log" subfolder of the output folder.
+    """
     log_folder = os.path.join(output_folder, "log")
     os.makedirs(log_folder, exist_ok=True)
-
-    # Set up logging
     log_file = os.path.join(log_folder, f"geocode_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
     logging.basicConfig(
         filename=log_file,
@@ -180,6 +335,27 @@ def process_folder(input_folder, output_folder, server_url="http://localhost:808
         format='%(asctime)s - %(message)s'
     )
 
+
+def process_folder(input_folder, output_folder, server_url="http://localhost:8080", max_workers=None, cache=None,
+                   archive=None):
+    """
+    Process all CSV files in a folder and save results to an output folder.
+    Reverse geocoding results are kept in a persistent GeocodeCache between runs,
+    and nearby coordinates reuse them through a ProximityIndex.
+    With an offline ResponseArchive the folder is processed from archived Nominatim responses only.
+    """
+
+    # server_url = 'https://nominatim.openstreetmap.org'
+    # Ensure input folder exists
+    if not os.path.isdir(input_folder):
+        raise ValueError(f"{input_folder} is not a valid directory")
+
+    # Create output folder
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Set up logging
+    setup_logging(output_folder)
+
     # Find all CSV files in the folder
     csv_files = [f for f in os.listdir(input_folder) if f.lower().endswith('.csv')]
 
@@ -189,6 +365,11 @@ def process_folder(input_folder, output_folder, server_url="http://localhost:808
         return
 
     # Process each CSV file
+    own_cache = cache is None
+    if own_cache:
+        cache = GeocodeCache()
+    proximity = ProximityIndex(cache=cache)
+    limiter = AimdLimiter(max_limit=max_workers or GEOCODE_MAX_CONCURRENCY)
     created_file_counter = len(csv_files)
     for csv_file in csv_files:
         input_path = os.path.join(input_folder, csv_file)
@@ -200,7 +381,11 @@ def process_folder(input_folder, output_folder, server_url="http://localhost:808
 
         print(f"Processing {input_path}...")
         logging.info(f"Processing {input_path}")
-        process_csv(input_path, output_path, server_url, max_workers)
+        process_csv(input_path, output_path, server_url, max_workers, cache, archive, proximity, limiter)
+    cache.log_stats()
+    limiter.log_stats()
+    if own_cache:
+        cache.close()
     print(f'Created files .xlsx: {created_file_counter}')
     return created_file_counter
 
@@ -209,4 +394,4 @@ def process_folder(input_folder, output_folder, server_url="http://localhost:808
 if __name__ == "__main__":
     input_folder = r"D:\Users\bojan.jevtic.ed\Desktop\test"
     output_folder = r"D:\Users\bojan.jevtic.ed\Desktop\test\output"
-    process_folder(input_folder, output_folder, max_workers=2)
\ No newline at end of file
+    process_folder(input_folder, output_folder)
\ No newline at end of file
@@ -0,0 +1,166 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+from pathlib import Path
+
+from metrics import get_metrics
+from constants import GEOCODE_CACHE_PATH, GEOCODE_CACHE_TTL, GEOCODE_CACHE_MAX_ENTRIES, GEOCODE_CACHE_PRECISION, \
+    GEOCODE_CACHE_BUSY_TIMEOUT
+
+
+class GeocodeCache:
+    """
+    On-disk (SQLite) cache of Nominatim reverse geocoding results keyed by normalized coordinates.
+    """
+
+    def __init__(self, path=GEOCODE_CACHE_PATH, ttl=GEOCODE_CACHE_TTL, max_entries=GEOCODE_CACHE_MAX_ENTRIES,
+                 precision=GEOCODE_CACHE_PRECISION):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # other processes may write the same cache, wait for their (short) transactions instead of failing
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=GEOCODE_CACHE_BUSY_TIMEOUT)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS geocode ('
+            'coord_key TEXT PRIMARY KEY, '
+            'display_name TEXT, '
+            'address TEXT, '
+            'created_at REAL, '
+            'accessed_at REAL, '
+            'lat REAL, '
+            'lon REAL)'
+        )
+        # caches created before lat/lon columns: fill them from the coordinate key
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(geocode)')]
+        if 'lat' not in columns:
+            self._conn.execute('ALTER TABLE geocode ADD COLUMN lat REAL')
+            self._conn.execute('ALTER TABLE geocode ADD COLUMN lon REAL')
+            self._conn.execute(
+                "UPDATE geocode SET lat = CAST(substr(coord_key, 1, instr(coord_key, ',') - 1) AS REAL), "
+                "lon = CAST(substr(coord_key, instr(coord_key, ',') + 1) AS REAL)"
+            )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS geocode_accessed_at ON geocode (accessed_at)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS geocode_lat_lon ON geocode (lat, lon)')
+        self._conn.commit()
+
+    def key(self, lat, lon):
+        """
+        Normalize coordinates to a fixed precision string, e.g. '45.382400,20.390700'.
+        """
+        return f"{round(float(lat), self.precision):.{self.precision}f}," \
+               f"{round(float(lon), self.precision):.{self.precision}f}"
+
+    def get(self, lat, lon):
+        """
+        Return the cached {"display_name", "address"} dict or None if coordinates are unknown or expired.
+        """
+        coord_key = self.key(lat, lon)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT display_name, address, created_at FROM geocode WHERE coord_key = ?', (coord_key,)
+            ).fetchone()
+            if row is None or (self.ttl and now - row[2] > self.ttl):
+                self.misses += 1
+                get_metrics().inc('cache_misses_total', cache='geocode')
+                return None
+
+            self._conn.execute('UPDATE geocode SET accessed_at = ? WHERE coord_key = ?', (now, coord_key))
+            self._conn.commit()
+            self.hits += 1
+        get_metrics().inc('cache_hits_total', cache='geocode')
+        return {"display_name": row[0], "address": json.loads(row[1])}
+
+    def _row(self, lat, lon, address_data, now):
+        return (self.key(lat, lon), address_data["display_name"],
+                json.dumps(address_data["address"], ensure_ascii=False), now, now,
+                round(float(lat), self.precision), round(float(lon), self.precision))
+
+    def put(self, lat, lon, address_data):
+        """
+        Store a successful lookup. Failed lookups ("Error") are never cached so they are retried next run.
+        Every lookup is committed right away, so no write transaction stays open between calls.
+        """
+        self.put_many([(lat, lon, address_data)])
+
+    def put_many(self, entries):
+        """
+        Store many successful lookups in one transaction.
+
+        :param entries: iterable of (lat, lon, address data)
+        """
+        now = time.time()
+        rows = [self._row(lat, lon, address_data, now) for lat, lon, address_data in entries
+                if address_data["display_name"] != "Error"]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO geocode (coord_key, display_name, address, created_at, accessed_at, lat, lon) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+            )
+            self._conn.commit()
+            self._puts_since_evict += len(rows)
+            if self._puts_since_evict >= 1000:
+                self._evict()
+
+    def points_in(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Coordinates of the unexpired entries inside a bounding box.
+
+        :return: list of (float, float)
+        """
+        min_created_at = time.time() - self.ttl if self.ttl else 0
+        with self._lock:
+            return self._conn.execute(
+                'SELECT lat, lon FROM geocode WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ? AND created_at >= ?',
+                (min_lat, max_lat, min_lon, max_lon, min_created_at)
+            ).fetchall()
+
+    def _evict(self):
+        """
+        Drop expired entries and the least recently used ones above max_entries. Caller holds the lock.
+        """
+        if self.ttl:
+            self._conn.execute('DELETE FROM geocode WHERE created_at < ?', (time.time() - self.ttl,))
+        if self.max_entries:
+            count = self._conn.execute('SELECT COUNT(*) FROM geocode').fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    'DELETE FROM geocode WHERE coord_key IN '
+                    '(SELECT coord_key FROM geocode ORDER BY accessed_at LIMIT ?)',
+                    (count - self.max_entries,)
+                )
+        self._conn.commit()
+        self._puts_since_evict = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_ratio = (self.hits / total * 100) if total > 0 else 0
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": hit_ratio}
+
+    def log_stats(self, label=''):
+        stats = self.stats()
+        get_metrics().set('cache_hit_ratio', stats['hit_ratio'] / 100, cache='geocode')
+        stats_msg = f"{label}Geocode cache: hits {stats['hits']}, misses {stats['misses']} " \
+                    f"({stats['hit_ratio']:.2f}% hit ratio)"
+        print(stats_msg)
+        logging.info(stats_msg)
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._conn.close()
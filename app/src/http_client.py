@@ -0,0 +1,99 @@
+import time
+import random
+import logging
+import threading
+
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import get_metrics
+from constants import HTTP_TIMEOUT, HTTP_MAX_RETRIES, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_POOL_SIZE
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class HttpClient:
+    """
+    Thread-safe HTTP client with keep-alive connection pooling, default timeouts
+    and jittered exponential backoff on 5xx responses and connection errors.
+    """
+
+    def __init__(self, timeout=HTTP_TIMEOUT, max_retries=HTTP_MAX_RETRIES, backoff_base=HTTP_BACKOFF_BASE,
+                 backoff_max=HTTP_BACKOFF_MAX, pool_size=HTTP_POOL_SIZE):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def backoff(self, attempt):
+        """
+        Full jitter: a random delay between 0 and base * 2^attempt, capped by backoff_max.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def request(self, method, url, retries=None, endpoint=None, retry_read_timeouts=True, **kwargs):
+        """
+        Send a request, retrying transient failures. Raises requests.exceptions.RequestException
+        when retries are exhausted or the server answers with a non-retryable error status.
+        With retry_read_timeouts=False a read timeout is raised at once, for callers that handle slow
+        responses themselves.
+        Latency, status, retries and errors are recorded in the metrics under `endpoint`
+        (the last segment of the URL path by default).
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        retries = self.max_retries if retries is None else retries
+        endpoint = endpoint or urlparse(url).path.rstrip('/').rsplit('/', 1)[-1] or '/'
+        metrics = get_metrics()
+
+        for attempt in range(retries + 1):
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                metrics.observe('http_request_seconds', time.monotonic() - started, endpoint=endpoint)
+                metrics.inc('http_responses_total', endpoint=endpoint, status=response.status_code)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                    if response.status_code >= 400:
+                        metrics.inc('http_errors_total', endpoint=endpoint, reason=f'status {response.status_code}')
+                    response.raise_for_status()
+                    return response
+                reason = f'status {response.status_code}'
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.observe('http_request_seconds', time.monotonic() - started, endpoint=endpoint)
+                if attempt == retries or (not retry_read_timeouts
+                                          and isinstance(e, requests.exceptions.ReadTimeout)):
+                    metrics.inc('http_errors_total', endpoint=endpoint, reason=e.__class__.__name__)
+                    raise
+                reason = e.__class__.__name__
+
+            metrics.inc('http_retries_total', endpoint=endpoint)
+            delay = self.backoff(attempt)
+            logging.info(f'{method} {url} failed ({reason}), retry {attempt + 1}/{retries} in {delay:.1f}s')
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the process-wide HttpClient, creating it on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+from pathlib import Path
+
+from constants import JOB_WORKERS, TRIGGER_FOLDER
+from metrics import get_metrics
+
+# job priorities, lower runs first
+PRIORITY_TRIGGER = 0
+PRIORITY_UPDATE = 1
+PRIORITY_BACKFILL = 2
+
+
+class Job:
+    """
+    A unit of work for the JobRunner: func(*args).
+    `years` are the years the job reads and writes (None for all years); jobs with overlapping years
+    never run at the same time.
+    """
+
+    def __init__(self, name, func, args=(), priority=PRIORITY_UPDATE, years=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.years = None if years is None else set(years)
+
+    def conflicts(self, other):
+        return self.years is None or other.years is None or bool(self.years & other.years)
+
+    def __repr__(self):
+        return f'Job({self.name!r}, priority={self.priority})'
+
+
+class JobRunner:
+    """
+    A fixed pool of worker threads fed by a priority queue of jobs.
+    A job with the same name as a queued or running job isn't queued again, and a job waits while
+    a conflicting one runs; the next free worker takes the highest-priority job that can start.
+
+    shutdown() drops queued jobs and waits for the running ones to finish.
+    """
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._pending = []
+        self._running = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._work, name=f'job-{i}', daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job):
+        """
+        Queue a job.
+
+        :return: bool, False if the runner is shutting down or the job is already queued or running
+        """
+        with self._cond:
+            if self._stopping:
+                return False
+            if job.name in self._running or any(queued.name == job.name for _, _, queued in self._pending):
+                print(f'Job "{job.name}" is already queued or running')
+                return False
+            heapq.heappush(self._pending, (job.priority, next(self._seq), job))
+            self._cond.notify()
+        print(f'Job "{job.name}" queued')
+        logging.info(f'Job "{job.name}" queued')
+        return True
+
+    def _next_job(self):
+        """
+        Remove and return the highest-priority queued job which conflicts with no running job, or None.
+        Called with the condition held.
+        """
+        for entry in sorted(self._pending):
+            job = entry[2]
+            if not any(job.conflicts(running) for running in self._running.values()):
+                self._pending.remove(entry)
+                heapq.heapify(self._pending)
+                return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = None
+                while not self._stopping and job is None:
+                    job = self._next_job()
+                    if job is None:
+                        self._cond.wait()
+                if self._stopping:
+                    return
+                self._running[job.name] = job
+
+            print(f'Job "{job.name}" started')
+            logging.info(f'Job "{job.name}" started')
+            started = time.monotonic()
+            try:
+                job.func(*job.args)
+                status = 'done'
+            except Exception as e:
+                print(f'Job "{job.name}" failed: {e}')
+                logging.exception(f'Job "{job.name}" failed')
+                status = 'failed'
+            finally:
+                with self._cond:
+                    del self._running[job.name]
+                    self._cond.notify_all()
+            duration = time.monotonic() - started
+            get_metrics().inc('jobs_total', status=status)
+            get_metrics().observe('job_seconds', duration, job=job.name.split(' ', 1)[0])
+            print(f'Job "{job.name}" {status} in {duration:.1f}s')
+            logging.info(f'Job "{job.name}" {status} in {duration:.1f}s')
+
+    def running(self):
+        with self._cond:
+            return list(self._running)
+
+    def shutdown(self, wait=True):
+        """
+        Stop taking jobs: queued jobs are dropped, running ones finish unless wait is False.
+        """
+        with self._cond:
+            self._stopping = True
+            dropped = [job.name for _, _, job in self._pending]
+            self._pending.clear()
+            self._cond.notify_all()
+            running = list(self._running)
+        print(f'Shutting down: dropped queued jobs {dropped}, waiting for running jobs {running}')
+        logging.info(f'Shutting down: dropped queued jobs {dropped}, waiting for running jobs {running}')
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+def request_trigger(year, opstinas=None, folder=TRIGGER_FOLDER):
+    """
+    Ask the running service to collect a year, or some of its opstinas, now.
+
+    :param year: int
+    :param opstinas: list of str, the whole year if None
+    :return: Path, the trigger file
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder.joinpath(f'{time.time_ns()}.json')
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps({'year': year, 'opstinas': opstinas or None}, ensure_ascii=False),
+                        encoding='utf-8')
+    os.replace(tmp_path, path)
+    return path
+
+
+def poll_triggers(folder=TRIGGER_FOLDER):
+    """
+    Read and remove the trigger files written by request_trigger, oldest first.
+
+    :return: list of (int, list of str or None), year and opstinas
+    """
+    triggers = []
+    for path in sorted(Path(folder).glob('*.json')):
+        try:
+            trigger = json.loads(path.read_text(encoding='utf-8'))
+            triggers.append((int(trigger['year']), trigger.get('opstinas')))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f'Ignoring broken trigger {path}: {e}')
+        path.unlink(missing_ok=True)
+    return triggers
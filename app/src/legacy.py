@@ -0,0 +1,88 @@
+import re
+import logging
+
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+from constants import INPUT_FOLDER, OUTPUT_FOLDER, CONTRACT_KEY, LEGACY_OPSTINA, LEGACY_IMPORT_MARKER
+from geo_and_xlsx_conversion import GEO_COLUMNS, APPROXIMATED_COLUMN
+from storage import CONTRACTS_SCHEMA, typed
+
+YEAR_CSV = re.compile(r'^contracts_(\d{4})\.csv$')
+
+
+def read_legacy_csv(path):
+    """
+    :return: pd.DataFrame typed as CONTRACTS_SCHEMA, one row per contract key
+    """
+    try:
+        df = pd.read_csv(path, dtype=str)
+    except pd.errors.EmptyDataError:
+        return CONTRACTS_SCHEMA.empty_table().to_pandas()
+    return typed(df, CONTRACTS_SCHEMA).drop_duplicates(subset=CONTRACT_KEY, keep='last')
+
+
+def legacy_addresses(geocoded_df):
+    """
+    Geocode cache entries of the address columns of a legacy workbook, one per coordinate pair.
+
+    :return: list of (float, float, dict)
+    """
+    df = geocoded_df.dropna(subset=['latitude', 'longitude', 'display_name'])
+    df = df[df['display_name'] != 'Error'].drop_duplicates(subset=['latitude', 'longitude'])
+    entries = []
+    for row in df[['latitude', 'longitude', *GEO_COLUMNS]].itertuples(index=False, name=None):
+        lat, lon, display_name, *values = row
+        # parse_address reads these keys back into the same columns
+        address = {column: value for column, value in zip(GEO_COLUMNS[1:], values) if pd.notna(value)}
+        entries.append((lat, lon, {"display_name": display_name, "address": address}))
+    return entries
+
+
+def import_legacy(store, cache, input_folder=INPUT_FOLDER, output_folder=OUTPUT_FOLDER, marker=LEGACY_IMPORT_MARKER):
+    """
+    One-time import of the outputs written before the ContractStore existed.
+    contracts_<year>.csv of a past year becomes the year's LEGACY_OPSTINA partition, with the address columns of
+    contracts_<year>_with_location.xlsx as its geocoded partition, and the year is marked complete.
+    The addresses of every workbook go into the geocode cache, so the current year, which is collected again
+    as before, isn't geocoded again either. Years already in the store are left alone.
+
+    :param store: ContractStore
+    :param cache: GeocodeCache
+    :return: list of int, imported years
+    """
+    marker = Path(marker)
+    if marker.exists():
+        return []
+
+    imported = []
+    for path in sorted(Path(input_folder).glob('contracts_*.csv')):
+        match = YEAR_CSV.match(path.name)
+        if match is None:
+            continue
+        year = int(match.group(1))
+        xlsx_path = Path(output_folder).joinpath(f'contracts_{year}_with_location.xlsx')
+        geocoded_df = pd.read_excel(xlsx_path, dtype=object) if xlsx_path.exists() else None
+        if geocoded_df is not None:
+            cache.put_many(legacy_addresses(geocoded_df))
+        if year >= datetime.now().year or store.has_year(year) or store.partitions('contracts', year):
+            continue
+
+        contracts_df = read_legacy_csv(path)
+        store.write_partition('contracts', year, LEGACY_OPSTINA, contracts_df)
+        if geocoded_df is not None:
+            geocoded_df = geocoded_df.reindex(columns=CONTRACT_KEY + GEO_COLUMNS).assign(**{APPROXIMATED_COLUMN: False})
+            geocoded_df = geocoded_df.drop_duplicates(subset=CONTRACT_KEY, keep='last')
+            store.write_partition('geocoded', year, LEGACY_OPSTINA, geocoded_df)
+        store.mark_year_complete(year)
+        imported.append(year)
+        stats_msg = f'Imported {path.name}: {len(contracts_df)} rows' \
+                    + (f', addresses from {xlsx_path.name}' if geocoded_df is not None else '')
+        print(stats_msg)
+        logging.info(stats_msg)
+
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    marker.touch()
+    return imported
@@ -0,0 +1,167 @@
+import sqlite3
+import threading
+
+from datetime import datetime
+from pathlib import Path
+
+from collector import CollectTask
+from constants import MANIFEST_PATH
+
+PENDING, RUNNING, DONE, SPLIT = 'pending', 'running', 'done', 'split'
+
+
+class JobManifest:
+    """
+    Durable (SQLite) record of collection tasks: every (year, opstina, KO, window) request is
+    pending, running or done, with its row count, watermark and timestamps. A task whose window
+    was sharded is marked split and replaced by its shards.
+    Opstinas are recorded once their KO list is known, so a restart needs no re-enumeration.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS opstina ('
+            'year INTEGER, '
+            'opstina TEXT, '
+            'n_tasks INTEGER, '
+            'enumerated_at TEXT, '
+            'PRIMARY KEY (year, opstina))'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS task ('
+            'year INTEGER, '
+            'opstina TEXT, '
+            'kat_opstina TEXT, '
+            'start_date TEXT, '
+            'finish_date TEXT, '
+            'status TEXT, '
+            'rows INTEGER, '
+            'last_date TEXT, '
+            'last_id INTEGER, '
+            'attempts INTEGER DEFAULT 0, '
+            'error TEXT, '
+            'started_at TEXT, '
+            'finished_at TEXT, '
+            'PRIMARY KEY (year, opstina, kat_opstina, start_date, finish_date))'
+        )
+        # tasks left running by a crashed run are started again
+        self._conn.execute('UPDATE task SET status = ? WHERE status = ?', (PENDING, RUNNING))
+        self._conn.commit()
+
+    @staticmethod
+    def _key(task):
+        return task.year, str(task.opstina), str(task.kat_opstina), task.start_date, task.finish_date
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            cursor = self._conn.execute(sql, parameters)
+            self._conn.commit()
+        return cursor
+
+    def add_opstina(self, year, opst, tasks):
+        """
+        Record the tasks of an opstina as pending. Known tasks keep their status.
+        """
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO task (year, opstina, kat_opstina, start_date, finish_date, status) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [self._key(task) + (PENDING,) for task in tasks]
+            )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO opstina (year, opstina, n_tasks, enumerated_at) VALUES (?, ?, ?, ?)',
+                (year, str(opst), len(tasks), datetime.now().isoformat())
+            )
+            self._conn.commit()
+
+    def is_enumerated(self, year, opst):
+        row = self._execute('SELECT 1 FROM opstina WHERE year = ? AND opstina = ?', (year, str(opst))).fetchone()
+        return row is not None
+
+    def tasks(self, year, opst, status=None):
+        """
+        :return: list of CollectTask of an opstina, optionally only those with the given status;
+                 split tasks are left out unless asked for
+        """
+        sql = 'SELECT year, opstina, kat_opstina, start_date, finish_date FROM task WHERE year = ? AND opstina = ?'
+        parameters = (year, str(opst))
+        if status is not None:
+            sql += ' AND status = ?'
+            parameters += (status,)
+        else:
+            sql += ' AND status != ?'
+            parameters += (SPLIT,)
+        return [CollectTask(*row) for row in self._execute(sql + ' ORDER BY kat_opstina', parameters).fetchall()]
+
+    def mark_running(self, task):
+        self._execute(
+            'UPDATE task SET status = ?, attempts = attempts + 1, started_at = ? '
+            'WHERE year = ? AND opstina = ? AND kat_opstina = ? AND start_date = ? AND finish_date = ?',
+            (RUNNING, datetime.now().isoformat()) + self._key(task)
+        )
+
+    def mark_done(self, task, rows, mark=None):
+        """
+        :param mark: (last_date, last_id) of the task's contracts, see WatermarkStore.from_contracts
+        """
+        last_date, last_id = mark if mark is not None else (None, None)
+        self._execute(
+            'UPDATE task SET status = ?, rows = ?, last_date = ?, last_id = ?, error = NULL, finished_at = ? '
+            'WHERE year = ? AND opstina = ? AND kat_opstina = ? AND start_date = ? AND finish_date = ?',
+            (DONE, rows, last_date.isoformat() if last_date else None, last_id, datetime.now().isoformat())
+            + self._key(task)
+        )
+
+    def mark_failed(self, task, error):
+        self._execute(
+            'UPDATE task SET status = ?, error = ?, finished_at = ? '
+            'WHERE year = ? AND opstina = ? AND kat_opstina = ? AND start_date = ? AND finish_date = ?',
+            (PENDING, str(error), datetime.now().isoformat()) + self._key(task)
+        )
+
+    def split(self, task, shards):
+        """
+        Replace a task by the shards of its date window.
+        """
+        with self._lock:
+            self._conn.execute(
+                'UPDATE task SET status = ?, finished_at = ? '
+                'WHERE year = ? AND opstina = ? AND kat_opstina = ? AND start_date = ? AND finish_date = ?',
+                (SPLIT, datetime.now().isoformat()) + self._key(task)
+            )
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO task (year, opstina, kat_opstina, start_date, finish_date, status) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [self._key(shard) + (PENDING,) for shard in shards]
+            )
+            self._conn.commit()
+
+    def marks(self, year):
+        """
+        :return: dict {(opstina, kat_opstina): (last_date, last_id)} of the year's done tasks
+        """
+        rows = self._execute(
+            'SELECT opstina, kat_opstina, MAX(last_date), MAX(last_id) FROM task '
+            'WHERE year = ? AND status = ? AND last_date IS NOT NULL GROUP BY opstina, kat_opstina',
+            (year, DONE)
+        ).fetchall()
+        return {(opst, kat_opst): (datetime.fromisoformat(last_date), last_id)
+                for opst, kat_opst, last_date, last_id in rows}
+
+    def summary(self, year):
+        """
+        :return: dict {status: (tasks, rows)} of the year
+        """
+        rows = self._execute(
+            'SELECT status, COUNT(*), COALESCE(SUM(rows), 0) FROM task WHERE year = ? GROUP BY status', (year,)
+        ).fetchall()
+        return {status: (n_tasks, n_rows) for status, n_tasks, n_rows in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
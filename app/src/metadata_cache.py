@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import threading
+
+from pathlib import Path
+
+from metrics import get_metrics
+from constants import METADATA_PATH, METADATA_TTL, KAT_OPSTINA_TTL
+
+
+class MetadataCache:
+    """
+    JSON file with the landing page's form metadata and the katastarska opstina list of every opstina,
+    each with the time it was fetched. Expired or invalidated entries are fetched again by the caller.
+    """
+
+    def __init__(self, path=METADATA_PATH, ttl=METADATA_TTL, kat_opstina_ttl=KAT_OPSTINA_TTL):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.kat_opstina_ttl = kat_opstina_ttl
+        self._lock = threading.Lock()
+
+        self.data = {'form': None, 'kat_opstina': {}, 'shard_days': {}}
+        if self.path.exists():
+            try:
+                self.data.update(json.loads(self.path.read_text(encoding='utf-8')))
+            except ValueError:
+                print(f'Ignoring broken metadata cache {self.path}')
+
+    @staticmethod
+    def _is_fresh(entry, ttl, cache):
+        fresh = entry is not None and (not ttl or time.time() - entry['fetched_at'] <= ttl)
+        get_metrics().inc('cache_hits_total' if fresh else 'cache_misses_total', cache=cache)
+        return fresh
+
+    def _save(self):
+        """
+        Write the file atomically. Caller holds the lock.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        tmp_path.write_text(json.dumps(self.data, ensure_ascii=False), encoding='utf-8')
+        os.replace(tmp_path, self.path)
+
+    def get_form(self):
+        """
+        :return: dict with 'opstina_list', 'filter_list' and 'hashes', or None if missing or expired
+        """
+        with self._lock:
+            form = self.data['form']
+            return form if self._is_fresh(form, self.ttl, 'form') else None
+
+    def set_form(self, opstina_list, filter_list, hashes):
+        with self._lock:
+            self.data['form'] = {
+                'fetched_at': time.time(),
+                'opstina_list': opstina_list,
+                'filter_list': filter_list,
+                'hashes': list(hashes),
+            }
+            self._save()
+
+    def get_kat_opstina_list(self, opst):
+        """
+        :return: list of str, or None if missing or expired
+        """
+        with self._lock:
+            entry = self.data['kat_opstina'].get(str(opst))
+            return entry['list'] if self._is_fresh(entry, self.kat_opstina_ttl, 'kat_opstina') else None
+
+    def set_kat_opstina_list(self, opst, kat_opstina_list):
+        with self._lock:
+            self.data['kat_opstina'][str(opst)] = {'fetched_at': time.time(), 'list': kat_opstina_list}
+            self._save()
+
+    def get_shard_days(self, opst, kat_opst):
+        """
+        :return: int, longest window in days to request for the KO, or None if a whole year is fine
+        """
+        with self._lock:
+            return self.data['shard_days'].get(f'{opst}/{kat_opst}')
+
+    def set_shard_days(self, opst, kat_opst, days):
+        """
+        Set the longest window of the KO; a window of a year or more removes the limit.
+        """
+        key = f'{opst}/{kat_opst}'
+        with self._lock:
+            if days >= 366:
+                if self.data['shard_days'].pop(key, None) is None:
+                    return
+            elif self.data['shard_days'].get(key) == int(days):
+                return
+            else:
+                self.data['shard_days'][key] = int(days)
+            self._save()
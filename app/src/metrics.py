@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import bisect
+import logging
+import cProfile
+import pstats
+import threading
+
+from contextlib import contextmanager
+from pathlib import Path
+
+from constants import METRICS_FOLDER, METRICS_INTERVAL, PROFILE_STAGES
+
+# upper bounds of latency and stage time histograms, seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative, total = {}, 0
+        for bound, count in zip([*self.buckets, '+Inf'], self.counts):
+            total += count
+            cumulative[str(bound)] = total
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+
+class Metrics:
+    """
+    Process-wide counters, gauges and histograms with labels, e.g.
+    http_request_seconds{endpoint="reverse"} or stage_rows_total{stage="parse"}.
+    Snapshots are written as JSON and as a Prometheus textfile (for node_exporter's textfile collector).
+    """
+
+    def __init__(self, folder=METRICS_FOLDER, interval=METRICS_INTERVAL, profile_stages=PROFILE_STAGES):
+        self.folder = Path(folder)
+        self.interval = interval
+        self.profile_stages = set(profile_stages)
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.profiles = {}
+        self._profiling = False
+        self._lock = threading.Lock()
+        self._writer = None
+        self._runs = 0
+        self._stop = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def stage(self, stage):
+        """
+        Time a block as a stage: stage_seconds{stage} histogram, and a cProfile profile if the stage
+        is in profile_stages. Profiles of the same stage are merged.
+        Only one profiler can be active in a process (Python 3.12+ raises otherwise), so a block that starts
+        while another one is profiled (e.g. parse in another fetch thread) is timed but not profiled.
+        """
+        profiler = None
+        if stage in self.profile_stages:
+            with self._lock:
+                if not self._profiling:
+                    self._profiling = True
+                    profiler = cProfile.Profile()
+            if profiler is not None:
+                try:
+                    profiler.enable()
+                except ValueError:
+                    # another profiling tool is active
+                    profiler = None
+                    with self._lock:
+                        self._profiling = False
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.monotonic() - started, stage=stage)
+            if profiler is not None:
+                profiler.disable()
+                with self._lock:
+                    self._profiling = False
+                    if stage in self.profiles:
+                        self.profiles[stage].add(profiler)
+                    else:
+                        self.profiles[stage] = pstats.Stats(profiler)
+
+    def snapshot(self):
+        def labelled(name, labels):
+            return {'name': name, 'labels': dict(labels)}
+
+        with self._lock:
+            return {
+                'time': time.time(),
+                'counters': [{**labelled(*key), 'value': value} for key, value in sorted(self.counters.items())],
+                'gauges': [{**labelled(*key), 'value': value} for key, value in sorted(self.gauges.items())],
+                'histograms': [{**labelled(*key), **histogram.snapshot()}
+                               for key, histogram in sorted(self.histograms.items())],
+            }
+
+    @staticmethod
+    def _prometheus_labels(labels, **extra):
+        labels = {**labels, **extra}
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{name}="{str(value)}"' for name, value in labels.items()) + '}'
+
+    def prometheus(self, snapshot):
+        lines = []
+        for kind, metric_type in (('counters', 'counter'), ('gauges', 'gauge')):
+            for name in sorted({metric['name'] for metric in snapshot[kind]}):
+                lines.append(f'# TYPE {name} {metric_type}')
+                lines += [f"{name}{self._prometheus_labels(metric['labels'])} {metric['value']}"
+                          for metric in snapshot[kind] if metric['name'] == name]
+        for name in sorted({metric['name'] for metric in snapshot['histograms']}):
+            lines.append(f'# TYPE {name} histogram')
+            for metric in snapshot['histograms']:
+                if metric['name'] != name:
+                    continue
+                lines += [f"{name}_bucket{self._prometheus_labels(metric['labels'], le=bound)} {count}"
+                          for bound, count in metric['buckets'].items()]
+                lines.append(f"{name}_sum{self._prometheus_labels(metric['labels'])} {metric['sum']}")
+                lines.append(f"{name}_count{self._prometheus_labels(metric['labels'])} {metric['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Write metrics.json, metrics.prom and the profiles, each atomically.
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        snapshot = self.snapshot()
+        for file_name, text in (('metrics.json', json.dumps(snapshot, indent=1)),
+                                ('metrics.prom', self.prometheus(snapshot))):
+            tmp_path = self.folder.joinpath(file_name + '.tmp')
+            tmp_path.write_text(text, encoding='utf-8')
+            os.replace(tmp_path, self.folder.joinpath(file_name))
+        with self._lock:
+            for stage, stats in self.profiles.items():
+                stats.dump_stats(self.folder.joinpath(f'profile_{stage}.prof'))
+
+    def _write_periodically(self, stop):
+        while not stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.info(f'Writing metrics failed: {e}')
+
+    @contextmanager
+    def run(self, name):
+        """
+        Time a whole run (run_seconds{run}), write snapshots every `interval` seconds while it lasts
+        and once more at its end. Concurrent runs share one periodic writer.
+        """
+        started = time.monotonic()
+        with self._lock:
+            self._runs += 1
+            if self._writer is None and self.interval:
+                self._stop = threading.Event()
+                self._writer = threading.Thread(target=self._write_periodically, args=(self._stop,),
+                                                name='metrics', daemon=True)
+                self._writer.start()
+        try:
+            yield
+        finally:
+            writer = None
+            with self._lock:
+                self._runs -= 1
+                if not self._runs:
+                    writer, stop, self._writer = self._writer, self._stop, None
+            if writer is not None:
+                stop.set()
+                writer.join()
+            self.set('run_seconds', time.monotonic() - started, run=name)
+            self.set('run_finished_timestamp', time.time(), run=name)
+            self.write()
+            print(f'Metrics written to {self.folder}')
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Return the process-wide Metrics, creating it on first use.
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
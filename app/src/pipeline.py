@@ -0,0 +1,113 @@
+import time
+import queue
+import logging
+import threading
+
+from constants import PIPELINE_QUEUE_SIZE
+from metrics import get_metrics
+
+# tells a stage worker to stop
+_STOP = object()
+
+
+class Stage:
+    """
+    A pipeline stage: worker threads taking items from a bounded input queue and passing
+    handler results (if not None) to the next stage. put() blocks while the queue is full,
+    which slows the upstream stage down to this stage's pace.
+
+    A failing item is logged and dropped, the stage keeps running.
+    """
+
+    def __init__(self, name, handler, workers=1, maxsize=PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize)
+        self.downstream = None
+
+        self.items = 0
+        self.errors = 0
+        self.busy_time = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._work, name=f'{self.name}-{i}', daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            started = time.monotonic()
+            try:
+                with get_metrics().stage(self.name):
+                    result = self.handler(item)
+                if result is not None and self.downstream is not None:
+                    self.downstream.put(result)
+                with self._lock:
+                    self.items += 1
+            except Exception as e:
+                print(f'{self.name} failed on {item}: {e}')
+                logging.exception(f'{self.name} failed on {item}')
+                get_metrics().inc('stage_errors_total', stage=self.name)
+                with self._lock:
+                    self.errors += 1
+            finally:
+                with self._lock:
+                    self.busy_time += time.monotonic() - started
+
+    def close(self):
+        """
+        Wait until all queued items are handled and stop the workers.
+        """
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues, each running in its own threads, so that e.g. geocoding
+    of one partition overlaps with collecting the next one and with writing the previous one.
+    """
+
+    def __init__(self, stages, on_close=None):
+        self.stages = stages
+        self.on_close = on_close
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.downstream = next_stage
+        self.started = time.monotonic()
+        for stage in stages:
+            stage.start()
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def close(self):
+        """
+        Drain the stages in order and report their times.
+
+        :return: int, number of items the last stage has handled
+        """
+        try:
+            for stage in self.stages:
+                stage.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+        wall_time = time.monotonic() - self.started
+        for stage in self.stages:
+            stats_msg = f'Stage {stage.name}: {stage.items} items, {stage.errors} errors, ' \
+                        f'busy {stage.busy_time:.1f}s of {wall_time:.1f}s'
+            print(stats_msg)
+            logging.info(stats_msg)
+        return self.stages[-1].items
@@ -0,0 +1,111 @@
+import math
+import logging
+
+from collections import defaultdict
+
+from constants import GEOCODE_PROXIMITY_RADIUS, GEOCODE_PROXIMITY_REFERENCE_LAT
+
+# meters per degree of latitude, and the matching earth radius
+METERS_PER_DEGREE = 111_320
+EARTH_RADIUS = METERS_PER_DEGREE * 180 / math.pi
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    :return: float, great-circle distance in meters
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 \
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class ProximityIndex:
+    """
+    Grid index of geocoded points for nearest neighbour lookups within a radius in meters.
+    Points are bucketed in cells of the radius size, projected equirectangularly at one reference latitude,
+    so a lookup only scans the cells around the point; distances are great-circle distances.
+
+    Cells are loaded lazily from a GeocodeCache (points geocoded in earlier runs);
+    points resolved in the current run are added with add(). Without a cache the index keeps their addresses.
+    """
+
+    def __init__(self, radius=GEOCODE_PROXIMITY_RADIUS, cache=None, reference_lat=GEOCODE_PROXIMITY_REFERENCE_LAT):
+        self.radius = radius
+        self.cache = cache
+        self.meters_per_degree_lon = math.cos(math.radians(reference_lat)) * METERS_PER_DEGREE
+        self.cells = defaultdict(list)
+        self.loaded_cells = set()
+        self.addresses = {}
+        self.saved = 0
+
+    def project(self, lat, lon):
+        return lon * self.meters_per_degree_lon, lat * METERS_PER_DEGREE
+
+    def cell(self, x, y):
+        return math.floor(x / self.radius), math.floor(y / self.radius)
+
+    def _load_cell(self, cell):
+        """
+        Add the cached points of a cell to the index.
+        """
+        self.loaded_cells.add(cell)
+        if self.cache is None:
+            return
+        cell_x, cell_y = cell
+        min_lat = cell_y * self.radius / METERS_PER_DEGREE
+        max_lat = (cell_y + 1) * self.radius / METERS_PER_DEGREE
+        min_lon = cell_x * self.radius / self.meters_per_degree_lon
+        max_lon = (cell_x + 1) * self.radius / self.meters_per_degree_lon
+        for lat, lon in self.cache.points_in(min_lat, max_lat, min_lon, max_lon):
+            if self.cell(*self.project(lat, lon)) == cell:
+                self.cells[cell].append((lat, lon))
+
+    def add(self, lat, lon, address_data=None):
+        """
+        Index a geocoded point; its address is kept if there is no cache to read it from.
+        """
+        cell = self.cell(*self.project(lat, lon))
+        if cell not in self.loaded_cells:
+            self._load_cell(cell)
+        self.cells[cell].append((lat, lon))
+        if self.cache is None and address_data is not None:
+            self.addresses[(lat, lon)] = address_data
+
+    def address(self, lat, lon):
+        """
+        :return: dict, address data of an indexed point, or None if it isn't known
+        """
+        address_data = self.addresses.get((lat, lon))
+        if address_data is None and self.cache is not None:
+            address_data = self.cache.get(lat, lon)
+        return address_data
+
+    def nearest(self, lat, lon):
+        """
+        :return: (float, float), coordinates of the closest indexed point within the radius, or None
+        """
+        if not self.radius:
+            return None
+        cell_x, cell_y = self.cell(*self.project(lat, lon))
+        # a cell spans fewer meters of longitude north of the reference latitude
+        span_x = math.ceil(self.meters_per_degree_lon / (math.cos(math.radians(lat)) * METERS_PER_DEGREE))
+        best, best_distance = None, self.radius
+        for cell in ((cell_x + dx, cell_y + dy) for dx in range(-span_x, span_x + 1) for dy in (-1, 0, 1)):
+            if cell not in self.loaded_cells:
+                self._load_cell(cell)
+            for point_lat, point_lon in self.cells.get(cell, ()):
+                distance = haversine(lat, lon, point_lat, point_lon)
+                if distance <= best_distance:
+                    best, best_distance = (point_lat, point_lon), distance
+        return best
+
+    def log_stats(self, label='', saved=None):
+        """
+        :param saved: int, coordinates reused by one call; the total of the index if None
+        """
+        saved = self.saved if saved is None else saved
+        stats_msg = f"{label}Proximity index: {saved} coordinates reused from neighbours within " \
+                    f"{self.radius} m, HTTP calls saved: {saved}"
+        print(stats_msg)
+        logging.info(stats_msg)
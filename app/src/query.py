@@ -0,0 +1,350 @@
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+
+from constants import QUERY_INDEX_PATH, QUERY_LIMIT, QUERY_PORT
+from geo_and_xlsx_conversion import GEO_COLUMNS, APPROXIMATED_COLUMN
+from metrics import get_metrics
+from storage import ContractStore
+
+# index column -> store column; the address columns keep their names
+CONTRACT_COLUMNS = {
+    'contract_id': 'contract ID',
+    'object_id': 'object ID',
+    'date': 'date',
+    'contract_type': 'contract type',
+    'description': 'contract description',
+    'price': 'contract price',
+    'currency': 'currency',
+    'category': 'object category',
+    'area': 'pov',
+    'lat': 'latitude',
+    'lon': 'longitude',
+}
+INDEX_COLUMNS = ['year', 'opstina', *CONTRACT_COLUMNS, *GEO_COLUMNS, APPROXIMATED_COLUMN]
+
+# category of price statistics over all object categories, and of contracts with objects of several categories
+ALL_CATEGORIES = '*'
+MIXED_CATEGORY = 'mixed'
+
+
+def price_stats(df, year):
+    """
+    Median price per m² of an opstina's contracts by month, object category and currency.
+    A contract with several objects counts once, with its price over the total area of its objects;
+    contracts with an object of unknown area are left out.
+
+    :param df: pd.DataFrame, contracts of one opstina partition
+    :param year: int, months of other years are left out
+    :return: pd.DataFrame with month, category, currency, contracts, area and median_price_m2 columns
+    """
+    df = df[(df['contract price'] > 0) & (df['date'].dt.year == year)]
+    per_contract = df.groupby('contract ID').agg(
+        date=('date', 'first'), price=('contract price', 'first'), currency=('currency', 'first'),
+        area=('pov', 'sum'), areas=('pov', 'count'), objects=('pov', 'size'),
+        category=('object category', 'first'), categories=('object category', 'nunique'),
+    )
+    per_contract = per_contract[(per_contract['areas'] == per_contract['objects']) & (per_contract['area'] > 0)]
+    per_contract = per_contract.dropna(subset=['currency'])
+    per_contract['category'] = per_contract['category'].astype(object).where(per_contract['categories'] == 1,
+                                                                             MIXED_CATEGORY)
+    per_contract['month'] = per_contract['date'].dt.strftime('%Y-%m')
+    per_contract['price_m2'] = per_contract['price'] / per_contract['area']
+    per_contract['currency'] = per_contract['currency'].astype(object)
+
+    frames = []
+    for keys in (['month', 'category', 'currency'], ['month', 'currency']):
+        stats_df = per_contract.groupby(keys).agg(contracts=('price_m2', 'size'), area=('area', 'sum'),
+                                                  median_price_m2=('price_m2', 'median')).reset_index()
+        frames.append(stats_df if 'category' in keys else stats_df.assign(category=ALL_CATEGORIES))
+    return pd.concat(frames, ignore_index=True)[['month', 'category', 'currency', 'contracts', 'area',
+                                                 'median_price_m2']]
+
+
+def parse_bbox(value):
+    """
+    :param value: str, 'min_lat,min_lon,max_lat,max_lon'
+    :return: tuple of 4 floats
+    """
+    bbox = tuple(float(part) for part in value.split(','))
+    if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise ValueError(f'bbox must be min_lat,min_lon,max_lat,max_lon: {value}')
+    return bbox
+
+
+class ContractIndex:
+    """
+    SQLite copy of the geocoded contracts of the complete years of a ContractStore, for queries
+    by date, opstina (municipality), object category and bounding box (an R*Tree on lat/lon),
+    with the median price per m² by opstina and month precomputed.
+
+    refresh() reindexes only the partitions whose parquet files changed since the last refresh.
+    """
+
+    def __init__(self, path=QUERY_INDEX_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS contracts (id INTEGER PRIMARY KEY, year INTEGER, opstina TEXT, '
+            'contract_id INTEGER, object_id INTEGER, date TEXT, contract_type TEXT, description TEXT, '
+            'price REAL, currency TEXT, category TEXT, area REAL, lat REAL, lon REAL, '
+            + ''.join(f'{column} TEXT, ' for column in GEO_COLUMNS) + f'{APPROXIMATED_COLUMN} INTEGER)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS contracts_date ON contracts (date)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS contracts_opstina ON contracts (opstina, year, date)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS contracts_category ON contracts (category, date)')
+        self._conn.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS contracts_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS price_stats (opstina TEXT, month TEXT, category TEXT, currency TEXT, '
+            'contracts INTEGER, area REAL, median_price_m2 REAL, '
+            'PRIMARY KEY (opstina, month, category, currency)) WITHOUT ROWID'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS partition (year INTEGER, opstina TEXT, signature TEXT, '
+            'PRIMARY KEY (year, opstina))'
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def signature(store, year, opst):
+        """
+        Modification times of the contracts and geocoded files of a partition.
+        """
+        mtimes = []
+        for dataset in ('contracts', 'geocoded'):
+            path = store.partition_path(dataset, year, opst)
+            mtimes.append(str(path.stat().st_mtime_ns) if path.exists() else '-')
+        return ':'.join(mtimes)
+
+    def _delete_partition(self, year, opst):
+        self._conn.execute('DELETE FROM contracts_rtree WHERE id IN '
+                           '(SELECT id FROM contracts WHERE opstina = ? AND year = ?)', (opst, year))
+        self._conn.execute('DELETE FROM contracts WHERE opstina = ? AND year = ?', (opst, year))
+        self._conn.execute('DELETE FROM price_stats WHERE opstina = ? AND month LIKE ?', (opst, f'{year}-%'))
+        self._conn.execute('DELETE FROM partition WHERE year = ? AND opstina = ?', (year, opst))
+
+    def _index_partition(self, store, year, opst, signature):
+        df = store.read_partition_geocoded(year, opst)
+        rows_df = df.rename(columns={column: name for name, column in CONTRACT_COLUMNS.items()})
+        rows_df['date'] = rows_df['date'].dt.strftime('%Y-%m-%d')
+        rows_df['year'] = year
+        rows_df['opstina'] = opst
+        rows_df = rows_df.reindex(columns=INDEX_COLUMNS).astype(object)
+        rows_df = rows_df.where(rows_df.notna(), None)
+
+        self._delete_partition(year, opst)
+        first_id = self._conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM contracts').fetchone()[0]
+        rows_df.insert(0, 'id', range(first_id, first_id + len(rows_df)))
+        self._conn.executemany(f'INSERT INTO contracts (id, {", ".join(INDEX_COLUMNS)}) '
+                               f'VALUES ({", ".join("?" * (len(INDEX_COLUMNS) + 1))})',
+                               rows_df.itertuples(index=False, name=None))
+        located_df = rows_df[['id', 'lat', 'lat', 'lon', 'lon']].dropna()
+        self._conn.executemany('INSERT INTO contracts_rtree VALUES (?, ?, ?, ?, ?)',
+                               located_df.itertuples(index=False, name=None))
+        stats_df = price_stats(df, year)
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO price_stats VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((opst, *row) for row in stats_df.itertuples(index=False, name=None))
+        )
+        self._conn.execute('INSERT INTO partition VALUES (?, ?, ?)', (year, opst, signature))
+        return len(rows_df)
+
+    def refresh(self, store):
+        """
+        Bring the index up to date with the complete years of the store.
+
+        :param store: ContractStore
+        :return: int, number of partitions reindexed
+        """
+        started = time.monotonic()
+        with self._lock:
+            indexed = {(year, opst): signature for year, opst, signature
+                       in self._conn.execute('SELECT year, opstina, signature FROM partition')}
+            current = {(year, opst): self.signature(store, year, opst)
+                       for year in store.years() for opst in store.partitions('contracts', year)}
+
+            for year, opst in indexed.keys() - current.keys():
+                self._delete_partition(year, opst)
+            changed = [partition for partition, signature in current.items() if indexed.get(partition) != signature]
+            rows = 0
+            for year, opst in sorted(changed):
+                rows += self._index_partition(store, year, opst, current[(year, opst)])
+                self._conn.commit()
+            self._conn.commit()
+        stats_msg = f'Query index: {len(changed)} of {len(current)} partitions reindexed ({rows} rows) ' \
+                    f'in {time.monotonic() - started:.1f}s'
+        print(stats_msg)
+        logging.info(stats_msg)
+        return len(changed)
+
+    def _query(self, sql, params):
+        started = time.monotonic()
+        with self._lock:
+            df = pd.read_sql_query(sql, self._conn, params=params)
+        get_metrics().observe('query_seconds', time.monotonic() - started)
+        return df
+
+    def contracts(self, start=None, end=None, opstina=None, category=None, bbox=None, limit=QUERY_LIMIT):
+        """
+        Contracts matching all given filters, ordered by date.
+
+        :param start: str, 'YYYY-MM-DD', inclusive
+        :param end: str, 'YYYY-MM-DD', inclusive
+        :param opstina: str
+        :param category: str, object category
+        :param bbox: (min_lat, min_lon, max_lat, max_lon)
+        :param limit: int, None for all rows
+        :return: pd.DataFrame
+        """
+        tables, where, params = 'contracts', [], []
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            # the R*Tree stores 32-bit floats rounded outwards, the exact test is on the contracts columns
+            tables += ' JOIN contracts_rtree ON contracts_rtree.id = contracts.id'
+            where += ['contracts_rtree.max_lat >= ?', 'contracts_rtree.min_lat <= ?',
+                      'contracts_rtree.max_lon >= ?', 'contracts_rtree.min_lon <= ?',
+                      'contracts.lat BETWEEN ? AND ?', 'contracts.lon BETWEEN ? AND ?']
+            params += [min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon]
+        for condition, value in (('date >= ?', start), ('date <= ?', end), ('opstina = ?', opstina),
+                                 ('category = ?', category)):
+            if value is not None:
+                where.append(condition)
+                params.append(value)
+        sql = f'SELECT {", ".join("contracts." + column for column in INDEX_COLUMNS)} FROM {tables}'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY date, contract_id, object_id'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return self._query(sql, params)
+
+    def prices(self, opstina=None, start=None, end=None, category=ALL_CATEGORIES, currency=None):
+        """
+        Precomputed median price per m² by opstina and month.
+
+        :param start: str, 'YYYY-MM', inclusive
+        :param end: str, 'YYYY-MM', inclusive
+        :param category: str, object category; ALL_CATEGORIES for all contracts, MIXED_CATEGORY for contracts
+            with objects of several categories
+        :return: pd.DataFrame
+        """
+        where, params = [], []
+        for condition, value in (('opstina = ?', opstina), ('month >= ?', start), ('month <= ?', end),
+                                 ('category = ?', category), ('currency = ?', currency)):
+            if value is not None:
+                where.append(condition)
+                params.append(value)
+        sql = 'SELECT * FROM price_stats'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY opstina, month, category, currency'
+        return self._query(sql, params)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def records(df):
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    GET /contracts?start=&end=&opstina=&category=&bbox=min_lat,min_lon,max_lat,max_lon&limit=
+    GET /prices?opstina=&start=&end=&category=&currency=
+    Both answer with a JSON list of rows.
+    """
+    index = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/contracts':
+                if 'bbox' in params:
+                    params['bbox'] = parse_bbox(params['bbox'])
+                if 'limit' in params:
+                    params['limit'] = int(params['limit'])
+                df = self.index.contracts(**params)
+            elif url.path == '/prices':
+                df = self.index.prices(**params)
+            else:
+                self.send_error(404)
+                return
+        except (TypeError, ValueError) as e:
+            self.send_error(400, str(e))
+            return
+
+        body = json.dumps(records(df), ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info(format % args)
+
+
+def serve(index, port=QUERY_PORT):
+    QueryHandler.index = index
+    server = ThreadingHTTPServer(('', port), QueryHandler)
+    print(f'Serving the query index on http://localhost:{port}/contracts and /prices')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query collected contracts without loading the whole store')
+    parser.add_argument('--index', type=Path, default=QUERY_INDEX_PATH, help='index database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('refresh', help='index partitions changed since the last refresh')
+    contracts_parser = commands.add_parser('contracts', help='contracts matching the filters, as CSV')
+    contracts_parser.add_argument('--start', help='first date, YYYY-MM-DD')
+    contracts_parser.add_argument('--end', help='last date, YYYY-MM-DD')
+    contracts_parser.add_argument('--opstina')
+    contracts_parser.add_argument('--category', help='object category')
+    contracts_parser.add_argument('--bbox', type=parse_bbox, help='min_lat,min_lon,max_lat,max_lon')
+    contracts_parser.add_argument('--limit', type=int, default=QUERY_LIMIT)
+    prices_parser = commands.add_parser('prices', help='median price per m2 by opstina and month, as CSV')
+    prices_parser.add_argument('--opstina')
+    prices_parser.add_argument('--start', help='first month, YYYY-MM')
+    prices_parser.add_argument('--end', help='last month, YYYY-MM')
+    prices_parser.add_argument('--category', default=ALL_CATEGORIES, help='object category, all by default')
+    prices_parser.add_argument('--currency')
+    serve_parser = commands.add_parser('serve', help='answer queries over HTTP')
+    serve_parser.add_argument('--port', type=int, default=QUERY_PORT)
+    args = parser.parse_args()
+
+    contract_index = ContractIndex(args.index)
+    if args.command == 'refresh':
+        contract_index.refresh(ContractStore())
+    elif args.command == 'serve':
+        serve(contract_index, args.port)
+    else:
+        query_started = time.monotonic()
+        if args.command == 'contracts':
+            result_df = contract_index.contracts(args.start, args.end, args.opstina, args.category, args.bbox,
+                                                 args.limit)
+        else:
+            result_df = contract_index.prices(args.opstina, args.start, args.end, args.category, args.currency)
+        print(result_df.to_csv(index=False), end='')
+        print(f'{len(result_df)} rows in {time.monotonic() - query_started:.3f}s', file=sys.stderr)
@@ -0,0 +1,213 @@
+import sys
+import json
+import argparse
+import tempfile
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from admin_resolver import get_default_resolver
+from archive import ResponseArchive
+from collector import DATE_FORMAT
+from proximity_index import ProximityIndex
+from query import ContractIndex
+from constants import ARCHIVE_FOLDER, PARQUET_FOLDER, OUTPUT_FOLDER, CONTRACT_KEY, EXPORT_XLSX, SEEN_KEYS_PATH, \
+    QUERY_INDEX
+from export import export_store
+from geo_and_xlsx_conversion import geocode_contracts
+from geocode_cache import GeocodeCache
+from metadata_cache import MetadataCache
+from scraper import Scraper
+from seen_keys import SeenKeys
+from storage import ContractStore, CONTRACTS_SCHEMA, typed
+
+
+def replay_contracts(year, opst, archive_root=ARCHIVE_FOLDER, store_root=PARQUET_FOLDER):
+    """
+    Parse all archived katastar responses of an opstina into its contracts partition.
+    Responses are applied in the order they were archived, so later data replaces earlier rows with the same key,
+    and rows of a KO dated inside a later response's window which that response doesn't contain are removed,
+    as the weekly update removes them. Removals are applied per KO window, so replay also drops rows that a weekly
+    run kept because another KO of the opstina failed.
+
+    :return: (int, str, int), year, opstina and number of rows
+    """
+    archive = ResponseArchive(archive_root, offline=True)
+    entries = [archive.read(path) for path in archive.files('katastar', f'year={year}/opstina={opst}')]
+    entries.sort(key=lambda entry: entry['archived_at'])
+
+    df = None
+    for entry in entries:
+        params = entry['params']
+        kat_opst = str(params['KoID'])
+        batch_df = Scraper.parse_data(json.loads(entry['response'])['d']['Ugovori'], kat_opst)
+        if df is None:
+            df = batch_df
+            continue
+        start = datetime.strptime(params['DatumPocetak'], DATE_FORMAT)
+        finish = datetime.strptime(params['DatumZavrsetak'], DATE_FORMAT) + timedelta(days=1)
+        in_window = (df['kat_opstina'] == kat_opst) & (df['date'] >= start) & (df['date'] < finish)
+        is_removed = in_window.to_numpy() \
+            & ~pd.MultiIndex.from_frame(df[CONTRACT_KEY]).isin(pd.MultiIndex.from_frame(batch_df[CONTRACT_KEY]))
+        df = df[~is_removed]
+        if not batch_df.empty:
+            df = pd.concat([df, batch_df], ignore_index=True)
+
+    if df is not None and not df.empty:
+        df = typed(df, CONTRACTS_SCHEMA).drop_duplicates(subset=CONTRACT_KEY, keep='last')
+    else:
+        df = CONTRACTS_SCHEMA.empty_table().to_pandas()
+    rows = ContractStore(store_root).write_partition('contracts', year, opst, df)
+    return year, opst, rows
+
+
+def replay_geocoded(year, opst, archive_root=ARCHIVE_FOLDER, store_root=PARQUET_FOLDER, cache_path=None,
+                    write=True):
+    """
+    Geocode the contracts partition of an opstina from archived Nominatim responses only.
+    Coordinates which aren't archived (the live run took their address from a neighbour) get the address of
+    the nearest archived point within the proximity radius. Archived points are collected in a GeocodeCache
+    at cache_path, shared by the replay processes; replay() fills it in a first pass with write=False,
+    so the neighbours of the second pass come from every replayed opstina. The second pass only looks up
+    neighbours in the cache; exact coordinates are answered by the archive, as they were in the live run.
+
+    :return: (int, str, int), year, opstina and number of rows without an archived address
+    """
+    archive = ResponseArchive(archive_root, offline=True)
+    store = ContractStore(store_root)
+    cache = GeocodeCache(cache_path, ttl=None, max_entries=None) if cache_path is not None else None
+    contracts_df = store.read_partition('contracts', year, opst)
+    geocoded_df = geocode_contracts(contracts_df, max_workers=1, cache=None if write else cache,
+                                    label=f'{year}/{opst}', archive=archive, resolver=get_default_resolver(),
+                                    proximity=ProximityIndex(cache=cache))
+    if write:
+        store.write_partition('geocoded', year, opst, geocoded_df)
+    if cache is not None:
+        cache.close()
+    return year, opst, int((geocoded_df['display_name'] == 'Error').sum())
+
+
+def archived_partitions(archive, years=None):
+    """
+    :return: list of (int, str), (year, opstina) with archived katastar responses
+    """
+    partitions = []
+    for partition in archive.partitions('katastar'):
+        year_part, opst_part = partition.split('/')
+        year, opst = int(year_part.split('=', 1)[1]), opst_part.split('=', 1)[1]
+        if years is None or year in years:
+            partitions.append((year, opst))
+    return partitions
+
+
+def replay(years=None, processes=None, archive_root=ARCHIVE_FOLDER, store_root=PARQUET_FOLDER, geocode=True,
+           export=EXPORT_XLSX, seen_keys_path=SEEN_KEYS_PATH, index=QUERY_INDEX):
+    """
+    Rebuild the store (and contracts.xlsx) from the response archive with no network I/O.
+    Opstinas are parsed and geocoded in parallel processes.
+    Keys of the replayed years are dropped from the store's key index; the next update registers them again.
+
+    :param years: list of int, all archived years if None
+    :return: None
+    """
+    archive = ResponseArchive(archive_root, offline=True)
+    store = ContractStore(store_root)
+
+    partitions = archived_partitions(archive, years)
+    replay_years = sorted({year for year, _ in partitions})
+    print(f'Replaying {len(partitions)} opstinas of years {replay_years}')
+
+    # a replayed year is complete if it was before, or if every known opstina is in the archive
+    form = MetadataCache().data['form']
+    opstina_list = set(form['opstina_list']) if form else None
+    complete = {year: store.has_year(year)
+                or (opstina_list is not None and opstina_list <= {opst for y, opst in partitions if y == year})
+                for year in replay_years}
+    seen = SeenKeys(seen_keys_path)
+    for year in replay_years:
+        store.drop_year('contracts', year)
+        store.drop_year('geocoded', year)
+        seen.drop_year(year)
+    seen.close()
+
+    arguments = list(zip(*partitions)) + [[archive_root] * len(partitions), [store_root] * len(partitions)]
+    with ProcessPoolExecutor(processes) as executor:
+        for year, opst, rows in executor.map(replay_contracts, *arguments):
+            print(f'{year}/{opst} has been replayed. Collected {rows} items')
+        for year in replay_years:
+            if complete[year]:
+                store.mark_year_complete(year)
+
+        if geocode:
+            with tempfile.TemporaryDirectory(prefix='replay_geocode_') as folder:
+                arguments.append([Path(folder).joinpath('geocode_cache.sqlite')] * len(partitions))
+                for _ in executor.map(replay_geocoded, *arguments, [False] * len(partitions)):
+                    pass
+                for year, opst, errors in executor.map(replay_geocoded, *arguments):
+                    print(f'{year}/{opst} has been geocoded. Not archived: {errors}')
+
+    if export:
+        export_store(store, OUTPUT_FOLDER.joinpath("contracts.xlsx"))
+    if index:
+        ContractIndex().refresh(store)
+
+
+def comparable(df):
+    """
+    Rows of a partition in key order with plain object columns, so partitions written by different runs compare equal.
+    The KO column is left out: partitions stored before it was recorded have no value there.
+    """
+    df = df.drop(columns=['kat_opstina'], errors='ignore').sort_values(CONTRACT_KEY, ignore_index=True)
+    return df.astype(object).where(df.notna(), None)
+
+
+def compare_stores(store, replayed_store, partitions, datasets=('contracts', 'geocoded')):
+    """
+    Compare the partitions of a store with the same partitions rebuilt by replay.
+
+    :return: list of (str, int, str), dataset, year and opstina of the partitions which differ
+    """
+    mismatches = []
+    for year, opst in partitions:
+        for dataset in datasets:
+            df = comparable(store.read_partition(dataset, year, opst))
+            replayed_df = comparable(replayed_store.read_partition(dataset, year, opst))
+            if df.equals(replayed_df):
+                continue
+            differing = len(df.merge(replayed_df, how='outer', indicator=True).query('_merge != "both"'))
+            print(f'{dataset} {year}/{opst} differs: {len(df)} rows in the store, {len(replayed_df)} replayed, '
+                  f'{differing} rows not in both')
+            mismatches.append((dataset, year, opst))
+    return mismatches
+
+
+def verify(years=None, processes=None, archive_root=ARCHIVE_FOLDER, store_root=PARQUET_FOLDER, geocode=True):
+    """
+    Replay the archive into a temporary store and compare it with the store, which is left unchanged.
+
+    :return: list of (str, int, str), dataset, year and opstina of the partitions which differ
+    """
+    partitions = archived_partitions(ResponseArchive(archive_root, offline=True), years)
+    with tempfile.TemporaryDirectory(prefix='replay_') as folder:
+        replay(years, processes, archive_root, Path(folder).joinpath('parquet'), geocode=geocode, export=False,
+               seen_keys_path=Path(folder).joinpath('seen_keys.sqlite'), index=False)
+        mismatches = compare_stores(ContractStore(store_root), ContractStore(Path(folder).joinpath('parquet')),
+                                    partitions, ('contracts', 'geocoded') if geocode else ('contracts',))
+    print(f'{len(partitions)} opstinas compared, {len(mismatches)} partitions differ')
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild outputs from archived responses without network access')
+    parser.add_argument('years', nargs='*', type=int, help='years to replay, all archived years by default')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, CPU count by default')
+    parser.add_argument('--no-geocode', action='store_true', help='only rebuild the contracts dataset')
+    parser.add_argument('--verify', action='store_true',
+                        help='replay into a temporary folder and compare with the store instead of replacing it')
+    args = parser.parse_args()
+    if args.verify:
+        sys.exit(1 if verify(args.years or None, args.processes, geocode=not args.no_geocode) else 0)
+    replay(args.years or None, args.processes, geocode=not args.no_geocode)
@@ -1,10 +1,10 @@
 import re
-import os
 import time
-import threading
 
+import threading
 import urllib.parse
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 
 import requests
@@ -14,22 +14,64 @@ import xlsxwriter
 
 from bs4 import BeautifulSoup
 
-from geo_and_xlsx_conversion import process_folder
-from constants import DEFAULT_HEADERS, BASE_URL, REPLACE_DICT, INPUT_FOLDER, OUTPUT_FOLDER
+from http_client import get_client
+from collector import CollectionEngine, CollectTask, AimdLimiter, split_window, window_days, halve_task, DATE_FORMAT
+from storage import ContractStore, CONTRACTS_SCHEMA, typed
+from geocode_cache import GeocodeCache
+from export import export_store
+from watermark import WatermarkStore
+from metadata_cache import MetadataCache
+from archive import ResponseArchive
+from manifest import JobManifest, DONE
+from pipeline import Pipeline, Stage
+from seen_keys import SeenKeys
+from changes import ChangeLog, mark_changes, NEW, CHANGED, REMOVED
+from metrics import get_metrics
+from geo_and_xlsx_conversion import geocode_contracts
+from admin_resolver import get_default_resolver
+from proximity_index import ProximityIndex
+from query import ContractIndex
+from legacy import import_legacy
+from constants import DEFAULT_HEADERS, BASE_URL, NOMINATIM_URL, REPLACE_DICT, OUTPUT_FOLDER, CONTRACT_KEY, \
+    EXPORT_XLSX, QUERY_INDEX, SHARD_MAX_RESPONSE_BYTES, SHARD_MAX_LATENCY, SHARD_MIN_DAYS, SHARD_GROW_RATIO, \
+    LEGACY_OPSTINA
 
 
 class Parameters:
 
-    def __init__(self):
-        response = requests.get(BASE_URL, headers=DEFAULT_HEADERS)
-        self.html = response.text
+    def __init__(self, cache=None, base_url=BASE_URL):
+        self.cache = cache or MetadataCache()
+        self.base_url = base_url
+        self._lock = threading.Lock()
+
+        form = self.cache.get_form()
+        if form is None:
+            self.refresh()
+        else:
+            self.opstina_list = form['opstina_list']
+            self.filter_list = form['filter_list']
+            self.VIEWSTATE, self.VIEWSTATEGENERATOR, self.EVENTVALIDATION = form['hashes']
+            print(f'Loaded {len(self.opstina_list)} options of field "Opstina" from cache')
+        print()
 
-        self.soup = BeautifulSoup(response.text, 'lxml')
+    def refresh(self, stale_viewstate=None):
+        """
+        Download the landing page and update the cached form metadata.
+        If stale_viewstate is given, nothing is done when another thread has already replaced it.
+        """
+        with self._lock:
+            if stale_viewstate is not None and stale_viewstate != self.VIEWSTATE:
+                return
+            response = get_client().get(self.base_url, headers=DEFAULT_HEADERS, endpoint='landing')
+            self.html = response.text
 
-        self.opstina_list = self.get_opstina_list()
-        self.filter_list = self.get_filters()
-        self.VIEWSTATE, self.VIEWSTATEGENERATOR, self.EVENTVALIDATION = self.get_hashes(self.html)
-        print()
+            self.soup = BeautifulSoup(response.text, 'lxml')
+
+            self.opstina_list = self.get_opstina_list()
+            self.filter_list = self.get_filters()
+            self.VIEWSTATE, self.VIEWSTATEGENERATOR, self.EVENTVALIDATION = self.get_hashes(self.html)
+            self.cache.set_form(self.opstina_list, self.filter_list,
+                                (self.VIEWSTATE, self.VIEWSTATEGENERATOR, self.EVENTVALIDATION))
 
     def get_opstina_list(self):
         # get options from '--- Opstina ---'
@@ -68,6 +110,10 @@ class Parameters:
         return __VIEWSTATE, __VIEWSTATEGENERATOR, __EVENTVALIDATION
 
 
+# Cyrillic to Latin, lower and upper case
+TRANSLATE_TABLE = str.maketrans({**REPLACE_DICT, **{k.upper(): v.upper() for k, v in REPLACE_DICT.items()}})
+
+
 class Utils:
 
     @staticmethod
@@ -75,24 +121,32 @@ class Utils:
         return urllib.parse.quote(input_string, safe='')
 
     @staticmethod
-    def drop_dupl(df, path):
-        df = pd.read_csv(path, delimiter=',')
-        df = df.drop_duplicates()
-        data_csv = df.to_csv(path, index=False)
-        return data_csv
-
-    @staticmethod
+    @lru_cache(maxsize=4096)
     def translate_info(info):
-        replace_dict = REPLACE_DICT
-        replace_dict.update({k.upper(): v.upper() for k, v in replace_dict.items()})
-        info = info.translate({ord(k): v for k, v in replace_dict.items()})
-        return info
+        return info.translate(TRANSLATE_TABLE)
 
 
 class Scraper:
 
-    def __init__(self):
-        self.parameters = Parameters()
+    def __init__(self, base_url=BASE_URL, nominatim_url=NOMINATIM_URL):
+        self.base_url = base_url
+        self.data_url = base_url + 'Default.aspx/Data'
+        self.nominatim_url = nominatim_url
+        self.client = get_client()
+        self.engine = CollectionEngine()
+        self.watermarks = WatermarkStore()
+        self.store = ContractStore()
+        self.manifest = JobManifest()
+        self.seen = SeenKeys()
+        self.archive = ResponseArchive()
+        self.parameters = Parameters(base_url=base_url)
+        self.index = ContractIndex() if QUERY_INDEX else None
+        self.changes = ChangeLog()
+        # jobs running at once share one cache connection and one Nominatim concurrency limit
+        self.geocode_cache = GeocodeCache()
+        self.geocode_limiter = AimdLimiter()
+        # jobs running at once share the outputs
+        self._result_lock = threading.Lock()
 
     def get_body_with_hashes(self, start_date, finish_date, opst):
         body_with_hashes = {
@@ -112,6 +166,28 @@ class Scraper:
         return body_with_hashes
 
     def get_kat_opstina_list(self, start_date, finish_date, opst):
+        """
+        KO list of an opstina from the metadata cache, or from a postback if it is missing or expired.
+        A postback rejected because of a stale ViewState is repeated once with fresh form metadata.
+
+        :return: list of str
+        """
+        kat_opstina_list = self.parameters.cache.get_kat_opstina_list(opst)
+        if kat_opstina_list is not None:
+            return kat_opstina_list
+
+        viewstate = self.parameters.VIEWSTATE
+        try:
+            kat_opstina_list = self.request_kat_opstina_list(start_date, finish_date, opst)
+        except (ValueError, requests.exceptions.HTTPError) as e:
+            print(f'Postback for {opst} failed ({e}), refreshing form metadata')
+            self.parameters.refresh(stale_viewstate=viewstate)
+            kat_opstina_list = self.request_kat_opstina_list(start_date, finish_date, opst)
+
+        self.parameters.cache.set_kat_opstina_list(opst, kat_opstina_list)
+        return kat_opstina_list
+
+    def request_kat_opstina_list(self, start_date, finish_date, opst):
         body = self.get_body_with_hashes(start_date, finish_date, opst)
         body = "&".join([f'{k}={Utils.to_url_parameter(v)}' for k, v in body.items()]) + "&"
 
@@ -133,155 +209,591 @@ class Scraper:
             'Sec-Fetch-Site': 'same-origin',
             'Pragma': 'no-cache',
         }
-        response = requests.post(BASE_URL, headers=headers, data=body)
+        response = self.client.post(self.base_url, headers=headers, data=body, endpoint='postback')
         soup = BeautifulSoup(response.text, 'lxml')
 
-        kat_opstina_fieldset = soup.select_one('select[name="KatastarskaOpstina"]').select('option')
+        kat_opstina_select = soup.select_one('select[name="KatastarskaOpstina"]')
+        if kat_opstina_select is None:
+            raise ValueError('no "KatastarskaOpstina" field in the response')
+        kat_opstina_fieldset = kat_opstina_select.select('option')
         kat_opstina_list = [option['value'] for option in kat_opstina_fieldset]
         return kat_opstina_list
 
     @staticmethod
-    def parse_data(raw_data):
+    def parse_data(raw_data, kat_opstina=None):
+        """
+        Flatten 'Ugovori' into one row per object of a contract.
+        Contract fields are repeated for every object; transliteration runs once per distinct value.
 
-        parser_data = []
+        :param raw_data: dict, 'Ugovori' of a Default.aspx/Data response
+        :param kat_opstina: str, the KO the response was requested for
+        :return: pd.DataFrame, typed as CONTRACTS_SCHEMA
+        """
+        contract_ids, dates, contract_types, descriptions, prices, currencies = [], [], [], [], [], []
+        object_ids, categories, povs, lats, lons = [], [], [], [], []
         for contract_data in raw_data.values():
-            for n in range(0, len(contract_data['n'])):
-                lat = contract_data['n'][n]['latlon']['Lat']
-                lon = contract_data['n'][n]['latlon']['Lon']
-                pov = contract_data['n'][n]['pov']
-                if not pov:
-                    pov = '-'
-
-                price = str(contract_data['cena'])
-                currency = str(contract_data['cenaV'])
-
-                row = {
-                    'contract ID': str(contract_data['uID']),
-                    'date': str(contract_data['datumU']),
-                    'contract type': Utils.translate_info(str(contract_data['ppNaziv'])),
-                    'contract description': Utils.translate_info(str(contract_data['vPromNaziv'])),
-                    'contract price': price,
-                    'currency': currency,
-                    'object ID': str(contract_data['n'][n]['pID']),
-                    'object category': Utils.translate_info(str(contract_data['n'][n]['vNepNaziv'])),
-                    'pov': str(pov),
-                    'latitude': str(lat),
-                    'longitude': str(lon),
-                }
-                parser_data.append(row)
-        return pd.DataFrame(parser_data)
+            objects = contract_data['n']
+            n = len(objects)
+            contract_ids += [contract_data['uID']] * n
+            dates += [contract_data['datumU']] * n
+            contract_types += [contract_data['ppNaziv']] * n
+            descriptions += [contract_data['vPromNaziv']] * n
+            prices += [contract_data['cena']] * n
+            currencies += [contract_data['cenaV']] * n
+            for obj in objects:
+                object_ids.append(obj['pID'])
+                categories.append(obj['vNepNaziv'])
+                povs.append(obj['pov'] or None)
+                lats.append(obj['latlon']['Lat'])
+                lons.append(obj['latlon']['Lon'])
+
+        df = pd.DataFrame({
+            'contract ID': contract_ids,
+            'date': dates,
+            'contract type': contract_types,
+            'contract description': descriptions,
+            'contract price': prices,
+            'currency': currencies,
+            'object ID': object_ids,
+            'object category': categories,
+            'pov': povs,
+            'latitude': lats,
+            'longitude': lons,
+            'kat_opstina': [kat_opstina] * len(contract_ids),
+        }, dtype=object)
+        for column in ('contract type', 'contract description', 'object category'):
+            df[column] = df[column].map(Utils.translate_info, na_action='ignore')
+        return typed(df, CONTRACTS_SCHEMA)
 
-    def collect_year_data(self, year):
+    @staticmethod
+    def get_year_window(year):
+        return f"01.01.{year}", f"31.12.{year}"
+
+    def make_tasks(self, year, opst, kat_opst, start_date, finish_date):
         """
-        Get data from a year and save it.
+        Requests for a KO in a date window. KOs known to have large or slow responses get
+        their window split into shards up front; everything else is requested in one call.
+
+        :return: list of CollectTask
+        """
+        max_days = self.parameters.cache.get_shard_days(opst, kat_opst)
+        if max_days is None:
+            return [CollectTask(year, opst, kat_opst, start_date, finish_date)]
+        return [CollectTask(year, opst, kat_opst, start, finish)
+                for start, finish in split_window(start_date, finish_date, max_days)]
+
+    def fetch_contracts(self, task):
+        """
+        Get contracts of one katastarska opstina in the task's date window.
+        A response over SHARD_MAX_RESPONSE_BYTES or SHARD_MAX_LATENCY is kept, but the KO's
+        later requests are split into proportionally shorter windows; a sharded KO whose responses
+        stay well under both limits gets its window doubled.
+
+        :param task: CollectTask
+        :return: pd.DataFrame
+        """
+        body = {
+            "DatumPocetak": task.start_date,
+            "DatumZavrsetak": task.finish_date,
+            "OpstinaID": task.opstina,
+            "KoID": task.kat_opstina,
+            "VrsteNepokretnosti": ",".join(self.parameters.filter_list)
+        }
+        started = time.monotonic()
+        # a window which times out is sharded instead of being retried as a whole (see split_task)
+        response = self.client.post(self.data_url, headers=DEFAULT_HEADERS, json=body, endpoint='data',
+                                    retry_read_timeouts=False)
+        latency = time.monotonic() - started
+        self.archive.put('katastar', body, response.text, partition=f'year={task.year}/opstina={task.opstina}')
+
+        size = len(response.content)
+        get_metrics().inc('http_response_bytes_total', size, endpoint='data')
+        ratio = max(size / SHARD_MAX_RESPONSE_BYTES, latency / SHARD_MAX_LATENCY)
+        days = window_days(task.start_date, task.finish_date)
+        shard_days = self.parameters.cache.get_shard_days(task.opstina, task.kat_opstina)
+        if ratio > 1:
+            days = max(SHARD_MIN_DAYS, int(days / ratio))
+        elif shard_days is not None and ratio < SHARD_GROW_RATIO:
+            # a short last shard of a window says little, so the window never shrinks here
+            days = max(shard_days, min(2 * shard_days, int(days / max(ratio, 0.01))))
+        else:
+            days = shard_days
+        if days != shard_days:
+            print(f'{task.opstina}/{task.kat_opstina}: {size} bytes in {latency:.1f}s, next requests use '
+                  + (f'windows of {days} days' if days < 366 else 'whole-year windows'))
+            self.parameters.cache.set_shard_days(task.opstina, task.kat_opstina, days)
+
+        with get_metrics().stage('parse'):
+            df = self.parse_data(response.json()["d"]["Ugovori"], task.kat_opstina)
+        get_metrics().inc('stage_rows_total', len(df), stage='parse')
+        return df
+
+    @staticmethod
+    def split_task(task, error):
+        """
+        Shards of a task whose response timed out. Other errors (5xx, 429, connection errors) were already
+        retried by the HTTP client and fail the task; the KO's later windows only change in fetch_contracts.
+
+        :return: list of CollectTask, empty if the task failed for another reason or can't be split any more
+        """
+        if not isinstance(error, requests.exceptions.ReadTimeout):
+            return []
+        shards = halve_task(task)
+        if shards:
+            print(f'Splitting {task.opstina}/{task.kat_opstina} {task.start_date} -- {task.finish_date} '
+                  f'into {len(shards)} windows')
+        return shards
+
+    def save_opstina_data(self, year, opst):
+        """
+        Compact collected data of an opstina into its partition and update the year's progress marker.
 
         :param year: int
+        :param opst: str
         :return: None
         """
-        result_filepath_year_data = Path(f"../data/contracts_{year}.csv")
-        print(f'Started collecting data from {year} year')
-        start_date, finish_date = f"01.01.{year}", f"31.12.{year}"
-
-        # get data for given year
-        # iterate for opstina
-        period_df = pd.DataFrame()
-        counter = 0
-        for opst in self.parameters.opstina_list:
-            filepath_year_data = Path(f"../data/contracts_{year}_{opst}.csv")
-            if filepath_year_data.exists():
-                print(f'Skip collecting data for {year}/{opst}')
-
-                try:
-                    period_df = pd.read_csv(filepath_year_data)
-                except Exception as e:
-                    if "No columns to parse from file" not in str(e):
-                        raise e
-                counter += 1
-                continue
+        rows = self.store.compact_opstina(year, opst, self.manifest.tasks(year, opst), self.seen)
+        if self.store.has_partition('contracts', year, LEGACY_OPSTINA):
+            keys_df = self.store.read_partition('contracts', year, opst, columns=CONTRACT_KEY)
+            self.drop_legacy_rows(year, pd.MultiIndex.from_frame(keys_df))
+        print(f'\n\n{year}/{opst} has been processed. Collected {rows} items')
+
+        for file in Path("../data").glob(f'opstina_{year}_status_*.txt'):
+            file.unlink()
+        counter = len(self.store.partitions('contracts', year))
+        Path(f"../data/opstina_{year}_status_{counter}_from_{len(self.parameters.opstina_list)}.txt").touch()
+
+    def drop_legacy_rows(self, year, keys):
+        """
+        Remove rows of the year's imported LEGACY_OPSTINA partition which an opstina partition now holds.
 
-            # iterate for katarska_opstina
-            kat_opstina_list = self.get_kat_opstina_list(start_date, finish_date, opst)
-            kat_len = len(kat_opstina_list)
-            kat_counter = 0
-            for kat_opst in kat_opstina_list:
-                kat_counter += 1
-                url = 'https://katastar.rgz.gov.rs/RegistarCenaNepokretnosti/Default.aspx/Data'
-                body = {
-                    "DatumPocetak": start_date,
-                    "DatumZavrsetak": finish_date,
-                    "OpstinaID": opst,
-                    "KoID": kat_opst,
-                    "VrsteNepokretnosti": ",".join(self.parameters.filter_list)
-                }
-                response = requests.post(url, headers=DEFAULT_HEADERS, json=body)
-                data = response.json()
-
-                data = data["d"]["Ugovori"]
-                part_df = self.parse_data(data)
-
-                print(f"Adding items to {start_date} -- {finish_date} period. "
-                      f"{opst} :: {kat_counter:03d}/{kat_len:03d} :: "
-                      f"{len(part_df):03d}")
-                period_df = pd.concat([period_df, part_df], ignore_index=True)
-
-            print(f'\n\n{year}/{opst} has been processed. Collected {len(period_df)} items')
-            period_df.to_csv(filepath_year_data, index=False)
-            for file in Path("../data").glob(f'opstina_{year}_status_*.txt'):
-                file.unlink()
-            counter += 1
-            Path(f"../data/opstina_{year}_status_{counter}_from_{len(self.parameters.opstina_list)}.txt").touch()
-
-            # Clear past files
-            for f_ in Path("../data").glob(f'contracts_{year}*.csv'):
-                if f_ != filepath_year_data:
-                    f_.unlink()
-                    f_.touch()
-
-        # Save Year's data
-        period_df = period_df.drop_duplicates()
-        period_df.to_csv(result_filepath_year_data, index=False)
-
-        # Remove all the temporary files
-        for f_ in Path("../data").glob(f'contracts_{year}*.csv'):
-            if f_ != result_filepath_year_data:
-                f_.unlink()
-
-    def collect_old_data(self):
+        :param keys: pd.MultiIndex of CONTRACT_KEY
         """
-        It collects old data for previously dates until now if data haven't been collected early.
+        if not self.store.has_partition('contracts', year, LEGACY_OPSTINA):
+            return
+        legacy_df = self.store.read_partition('contracts', year, LEGACY_OPSTINA)
+        is_collected = pd.MultiIndex.from_frame(legacy_df[CONTRACT_KEY]).isin(keys)
+        if is_collected.any():
+            self.store.write_partition('contracts', year, LEGACY_OPSTINA, legacy_df[~is_collected])
+            self.drop_geocoded(year, LEGACY_OPSTINA, keys)
+
+    def complete_year_data(self, year):
+        """
+        Mark the year as complete once every opstina has been collected.
+
+        :param year: int
+        :return: bool, True if the year is complete
+        """
+        missing = [opst for opst in self.parameters.opstina_list
+                   if not self.store.has_partition('contracts', year, opst)]
+        if missing:
+            tasks = ', '.join(f'{status} {n_tasks} ({n_rows} rows)'
+                              for status, (n_tasks, n_rows) in sorted(self.manifest.summary(year).items()))
+            print(f'{year} is incomplete: {len(missing)} opstinas are not collected yet; tasks: {tasks or "none"}')
+            return False
+
+        self.store.mark_year_complete(year)
+        for file in Path("../data").glob(f'opstina_{year}_status_*.txt'):
+            file.unlink()
+        print(f'{year} has been collected')
+        return True
+
+    def get_kat_opstina_lists(self, opstina_tasks):
+        """
+        Enumerate katastarska opstina of every (year, opstina).
+        KO lists are shared across years, so every opstina which isn't cached is requested only once.
+
+        :param opstina_tasks: list of (int, str)
+        :return: dict {(year, opstina): list of str}, without opstinas whose request failed
+        """
+        kat_opstina_by_opstina = {}
+        to_request = {}
+        for year, opst in opstina_tasks:
+            kat_opstina_list = self.parameters.cache.get_kat_opstina_list(opst)
+            if kat_opstina_list is not None:
+                kat_opstina_by_opstina[opst] = kat_opstina_list
+            else:
+                to_request.setdefault(opst, (year, opst))
+
+        def fetch_kat_opstina_list(opstina_task):
+            year, opst = opstina_task
+            return self.get_kat_opstina_list(*self.get_year_window(year), opst)
+
+        def add_kat_opstina_list(opstina_task, kat_opstina_list):
+            kat_opstina_by_opstina[opstina_task[1]] = kat_opstina_list
+
+        self.engine.run(to_request.values(), fetch_kat_opstina_list, add_kat_opstina_list)
+        return {(year, opst): kat_opstina_by_opstina[opst]
+                for year, opst in opstina_tasks if opst in kat_opstina_by_opstina}
+
+    def collect_years(self, years, on_opstina=None, opstinas=None):
+        """
+        Get data from the given years and save it.
+        All (opstina, katastarska opstina) requests of all years run on one CollectionEngine,
+        so its concurrency and rate limits hold however many years are queued.
 
+        :param years: list of int
+        :param on_opstina: callable(year, opstina), called when an opstina's partition is written
+        :param opstinas: list of str, all opstinas if None
         :return: None
         """
-        # Create a list to hold the threads
-        threads = []
+        def save_opstina_data(year, opst):
+            self.save_opstina_data(year, opst)
+            if on_opstina is not None:
+                on_opstina(year, opst)
+
+        # opstinas which haven't been collected yet
+        opstina_tasks = []
+        for year in years:
+            print(f'Started collecting data from {year} year')
+            for opst in opstinas or self.parameters.opstina_list:
+                if self.store.has_partition('contracts', year, opst):
+                    print(f'Skip collecting data for {year}/{opst}')
+                    continue
+                opstina_tasks.append((year, opst))
+
+        # katastarska opstina lists already recorded in the manifest are not enumerated again
+        to_enumerate = [opstina_task for opstina_task in opstina_tasks if not self.manifest.is_enumerated(*opstina_task)]
+        for (year, opst), kat_opstina_list in self.get_kat_opstina_lists(to_enumerate).items():
+            self.manifest.add_opstina(year, opst, [task for kat_opst in kat_opstina_list
+                                                   for task in self.make_tasks(year, opst, kat_opst,
+                                                                               *self.get_year_window(year))])
+
+        # flat list of unfinished requests for contracts
+        tasks, pending = [], {}
+        for year, opst in opstina_tasks:
+            if not self.manifest.is_enumerated(year, opst):
+                continue
+            done = set(self.manifest.tasks(year, opst, DONE))
+            opstina_tasks_todo = [task for task in self.manifest.tasks(year, opst)
+                                  if task not in done or not self.store.task_path(task).exists()]
+            pending[(year, opst)] = len(opstina_tasks_todo)
+            if not opstina_tasks_todo:
+                save_opstina_data(year, opst)
+            tasks += opstina_tasks_todo
+        print(f'{len(tasks)} requests to do')
+
+        def fetch_contracts(task):
+            self.manifest.mark_running(task)
+            return self.fetch_contracts(task)
+
+        def add_contracts(task, part_df):
+            key = (task.year, task.opstina)
+            rows = self.store.write_task(task, part_df)
+            self.manifest.mark_done(task, rows, self.watermarks.from_contracts(part_df))
+            get_metrics().inc('stage_rows_total', rows, stage='scrape')
+            get_metrics().inc('collect_tasks_total', status='done')
+            pending[key] -= 1
+            print(f"Adding items to {task.start_date} -- {task.finish_date} period. "
+                  f"{task.opstina} :: {task.kat_opstina} :: {len(part_df):03d} :: {pending[key]:03d} left")
+            if pending[key] == 0:
+                save_opstina_data(task.year, task.opstina)
+
+        def split_contracts_task(task, error):
+            shards = self.split_task(task, error)
+            if not shards:
+                self.manifest.mark_failed(task, error)
+                get_metrics().inc('collect_tasks_total', status='failed')
+                return []
+            self.manifest.split(task, shards)
+            get_metrics().inc('collect_tasks_total', status='split')
+            pending[(task.year, task.opstina)] += len(shards) - 1
+            return shards
+
+        with get_metrics().stage('scrape'):
+            self.engine.run(tasks, fetch_contracts, add_contracts, split_contracts_task)
+
+        for year in years:
+            # watermarks move only once the year's data is stored
+            if self.complete_year_data(year):
+                self.watermarks.update(self.manifest.marks(year))
+
+    def update_year_data(self, year, opstinas=None):
+        """
+        Incremental update: request every katastarska opstina only from its watermark (minus the overlap window)
+        and merge the new contracts into the year's opstina partitions.
+        Stored rows dated inside their KO's re-queried window which didn't come back are removed, along with
+        their address rows; KOs with a failed window keep their rows.
 
-        # Create threads for each task
-        updated_mark = False
-        for year in range(2012, datetime.now().year+1):
-            result_filepath_year_data = Path(f"../data/contracts_{year}.csv")
-            if result_filepath_year_data.exists():
-                print(f'Skip collecting data for {year}')
+        :param year: int
+        :param opstinas: list of str, all opstinas if None
+        :return: (dict {opstina: pd.DataFrame}, list of pd.DataFrame), rows that are new or changed compared
+            with the stored data, and the new, changed and removed rows marked for the ChangeLog
+        """
+        opstinas = opstinas or self.parameters.opstina_list
+        kat_opstina_lists = self.get_kat_opstina_lists([(year, opst) for opst in opstinas])
+        finish_date = self.get_year_window(year)[1]
+        tasks = [task for (year, opst), kat_opstina_list in kat_opstina_lists.items()
+                 for kat_opst in kat_opstina_list
+                 for task in self.make_tasks(year, opst, kat_opst,
+                                             self.watermarks.get_start_date(year, opst, kat_opst), finish_date)]
+
+        batches, marks = {}, {}
+
+        def add_contracts(task, part_df):
+            if not part_df.empty:
+                batches.setdefault(task.opstina, []).append(part_df)
+            get_metrics().inc('stage_rows_total', len(part_df), stage='scrape')
+            mark = self.watermarks.from_contracts(part_df)
+            if mark is not None:
+                marks[(task.opstina, task.kat_opstina)] = mark
+            print(f"Adding items to {task.start_date} -- {task.finish_date} period. "
+                  f"{task.opstina} :: {task.kat_opstina} :: {len(part_df):03d}")
+
+        with get_metrics().stage('scrape'):
+            failed = self.engine.run(tasks, self.fetch_contracts, add_contracts,
+                                     self.split_task)
+        get_metrics().inc('collect_tasks_total', len(failed), status='failed')
+
+        # watermarks of KOs with a failed window stay where they were
+        for task in failed:
+            marks.pop((task.opstina, task.kat_opstina), None)
+
+        # stored rows are checked for removal from their own KO's start date; KOs with a failed window are skipped
+        kat_opstina_starts = {}
+        for task in tasks:
+            start = datetime.strptime(task.start_date, DATE_FORMAT)
+            key = (task.opstina, task.kat_opstina)
+            kat_opstina_starts[key] = min(kat_opstina_starts.get(key, start), start)
+        # rows stored before their KO was recorded: every KO of the opstina covers the latest start date
+        covered_from = {}
+        for (opst, _), start in kat_opstina_starts.items():
+            covered_from[opst] = max(covered_from.get(opst, start), start)
+        for task in failed:
+            kat_opstina_starts.pop((task.opstina, task.kat_opstina), None)
+            covered_from.pop(task.opstina, None)
+
+        deltas, changes, removed = {}, [], 0
+        for opst in sorted(batches.keys() | {opst for opst, _ in kat_opstina_starts}):
+            # re-queried overlap rows are filtered by the key index
+            self.register_partition(year, opst)
+            if opst in batches:
+                batch_df = typed(pd.concat(batches[opst], ignore_index=True), CONTRACTS_SCHEMA)
+            else:
+                batch_df = CONTRACTS_SCHEMA.empty_table().to_pandas()
+            delta_df = self.seen.filter(batch_df)
+
+            stored_df = self.store.read_partition('contracts', year, opst,
+                                                  columns=[*CONTRACT_KEY, 'date', 'kat_opstina'])
+            stored_keys = pd.MultiIndex.from_frame(stored_df[CONTRACT_KEY])
+            kat_opstina = stored_df['kat_opstina'].astype(object)
+            window_start = pd.to_datetime(kat_opstina.map({kat_opst: start for (o, kat_opst), start
+                                                           in kat_opstina_starts.items() if o == opst}))
+            if opst in covered_from:
+                window_start = window_start.where(kat_opstina.notna(), covered_from[opst])
+            is_removed = (stored_df['date'] >= window_start).to_numpy() \
+                & ~stored_keys.isin(pd.MultiIndex.from_frame(batch_df[CONTRACT_KEY]))
+            # re-queried rows stored without their KO get it from the response
+            batch_kat_opstina = batch_df.drop_duplicates(subset=CONTRACT_KEY, keep='last') \
+                .set_index(CONTRACT_KEY)['kat_opstina'].astype(object)
+            filled = kat_opstina.fillna(pd.Series(batch_kat_opstina.reindex(stored_keys).to_numpy(),
+                                                  index=kat_opstina.index))
+            is_filled = kat_opstina.isna() & filled.notna()
+            if delta_df.empty and not is_removed.any() and not is_filled.any():
                 continue
 
-            updated_mark = True
-            thread = threading.Thread(target=self.collect_year_data, args=(year,))
-            threads.append(thread)
-            thread.start()
+            # newer rows replace stored ones with the same key
+            stored_df = self.store.read_partition('contracts', year, opst).assign(kat_opstina=filled)
+            is_new = ~pd.MultiIndex.from_frame(delta_df[CONTRACT_KEY]).isin(stored_keys)
+            merged_df = pd.concat([stored_df[~is_removed], delta_df], ignore_index=True)
+            merged_df = merged_df.drop_duplicates(subset=CONTRACT_KEY, keep='last')
+            self.store.write_partition('contracts', year, opst, merged_df)
+            self.seen.add(delta_df, year, opst)
+            if is_removed.any():
+                self.seen.remove(stored_df[is_removed])
+                self.drop_geocoded(year, opst, stored_keys[is_removed])
+            changes += [mark_changes(delta_df[is_new], NEW, opst), mark_changes(delta_df[~is_new], CHANGED, opst),
+                        mark_changes(stored_df[is_removed], REMOVED, opst)]
+            if not delta_df.empty:
+                deltas[opst] = delta_df
+            get_metrics().inc('update_delta_rows_total', len(delta_df))
+            get_metrics().inc('update_removed_rows_total', int(is_removed.sum()))
+            removed += int(is_removed.sum())
+        self.watermarks.update(marks)
+
+        print(f'{year}: {sum(len(delta_df) for delta_df in deltas.values())} new or changed rows, {removed} removed')
+        return deltas, changes
+
+    def drop_geocoded(self, year, opst, keys):
+        """
+        Remove the address rows of contracts removed from the store.
 
-        # Wait for all threads to finish
-        for thread in threads:
-            thread.join()
+        :param keys: pd.MultiIndex of CONTRACT_KEY
+        """
+        if not self.store.has_partition('geocoded', year, opst):
+            return
+        geocoded_df = self.store.read_partition('geocoded', year, opst)
+        is_removed = pd.MultiIndex.from_frame(geocoded_df[CONTRACT_KEY]).isin(keys)
+        if is_removed.any():
+            self.store.write_partition('geocoded', year, opst, geocoded_df[~is_removed])
+
+    def register_partition(self, year, opst):
+        """
+        Add the keys of a partition stored before the key index existed to the index.
+        """
+        if not self.seen.has_partition(year, opst):
+            self.seen.add_partition(self.store.read_partition('contracts', year, opst), year, opst)
 
-        print("All years are processed.")
+    def collect_new_opstinas(self, year, opstinas=None):
+        """
+        Collect the opstinas of a year which aren't stored yet.
 
-        self.check_files()
+        :param year: int
+        :param opstinas: list of str, all opstinas if None
+        :return: list of pd.DataFrame, rows of the collected opstinas marked new for the ChangeLog
+        """
+        missing = [opst for opst in opstinas or self.parameters.opstina_list
+                   if not self.store.has_partition('contracts', year, opst)]
+        if not missing:
+            return []
+        self.collect_years([year], opstinas=missing)
+        return [mark_changes(self.store.read_partition('contracts', year, opst), NEW, opst) for opst in missing
+                if self.store.has_partition('contracts', year, opst)]
 
-        print('started geodata collecting process')
-        created_file_mark = process_folder(INPUT_FOLDER, OUTPUT_FOLDER, max_workers=2)
-        if created_file_mark != 0:
-            self.get_result_file()
+    def collect_year_data(self, year):
+        """
+        Get data from a year and save it.
+
+        :param year: int
+        :return: None
+        """
+        self.collect_years([year])
+
+    def missing_years(self):
+        """
+        :return: list of int, years from 2012 until now which haven't been collected completely
+        """
+        return [year for year in range(2012, datetime.now().year+1) if not self.store.has_year(year)]
+
+    def collect_old_data(self, years=None):
+        """
+        It collects old data for previously dates until now if data haven't been collected early.
+        Every opstina is geocoded as soon as it is collected, while the collection goes on.
+
+        :param years: list of int, the years the job owns; missing years are collected and stored opstinas
+                      of these years are geocoded if they need it. All years if None
+        :return: bool, True if any year was missing
+        """
+        with get_metrics().run('collect_old_data'):
+            # outputs of the CSV/XLSX version are imported instead of collected and geocoded again;
+            # only years which aren't stored are imported, so they are among the missing years
+            import_legacy(self.store, self.geocode_cache)
+            owned = set(years) if years is not None else None
+            years = []
+            for year in range(2012, datetime.now().year+1):
+                if owned is not None and year not in owned:
+                    continue
+                if self.store.has_year(year):
+                    print(f'Skip collecting data for {year}')
+                    continue
+                years.append(year)
+
+            updated_mark = bool(years)
+            print('started geodata collecting process')
+            pipeline = self.geocoding_pipeline()
+            queued = set()
+
+            def geocode_opstina(year, opst):
+                queued.add((year, opst))
+                pipeline.put((year, opst))
+
+            try:
+                self.collect_years(years, on_opstina=geocode_opstina)
+                print("All years are processed.")
+                self.check_files()
+
+                # opstinas collected by earlier runs
+                for year in self.store.years():
+                    if owned is not None and year not in owned:
+                        continue
+                    for opst in self.store.partitions('contracts', year):
+                        if (year, opst) not in queued:
+                            geocode_opstina(year, opst)
+            finally:
+                created_file_mark = pipeline.close()
+            print(f'Geocoded partitions: {created_file_mark}')
+            if created_file_mark != 0:
+                self.get_result_file()
+
+            return updated_mark
+
+    def geocoding_pipeline(self, deltas=None):
+        """
+        Start the geocode and write stages. (year, opstina) items put into the pipeline are geocoded
+        if the opstina has no address columns yet, has new or changed rows in deltas, or has rows
+        without an address row or with an 'Error' address (their geocoding failed in an earlier run).
+        The first queue only holds partition keys, so it is unbounded and never blocks the collection;
+        geocoded partitions waiting to be written are bounded by PIPELINE_QUEUE_SIZE.
+        Pipelines of concurrent jobs share the Scraper's geocode cache and concurrency limiter.
+
+        :param deltas: dict {year: {opstina: pd.DataFrame}}, as returned by update_year_data
+        :return: Pipeline, close() returns the number of geocoded partitions written
+        """
+        deltas = deltas or {}
+        cache = self.geocode_cache
+        resolver = get_default_resolver()
+        proximity = ProximityIndex(cache=cache)
+        limiter = self.geocode_limiter
+
+        def geocode(item):
+            year, opst = item
+            label = f'{year}/{opst}'
+            year_deltas = deltas.get(year, {})
+            if not self.store.has_partition('geocoded', year, opst):
+                contracts_df = self.store.read_partition('contracts', year, opst)
+                geocoded_df = geocode_contracts(contracts_df, self.nominatim_url, cache=cache, label=label,
+                                                limiter=limiter, archive=self.archive, resolver=resolver,
+                                                proximity=proximity)
+            else:
+                geocoded_df = self.store.read_partition('geocoded', year, opst)
+                pending = [year_deltas[opst]] if opst in year_deltas else []
+                # rows of an earlier run whose geocoding failed have no address row or an 'Error' one
+                keys_df = self.store.read_partition('contracts', year, opst, columns=CONTRACT_KEY)
+                geocoded_keys = pd.MultiIndex.from_frame(geocoded_df.loc[geocoded_df['display_name'] != 'Error',
+                                                                         CONTRACT_KEY])
+                is_missing = ~pd.MultiIndex.from_frame(keys_df).isin(geocoded_keys)
+                if is_missing.any():
+                    pending.append(self.store.read_partition('contracts', year, opst)[is_missing])
+                if not pending:
+                    return None
+                pending_df = pd.concat(pending, ignore_index=True).drop_duplicates(subset=CONTRACT_KEY)
+                pending_geocoded_df = geocode_contracts(pending_df, self.nominatim_url, cache=cache, limiter=limiter,
+                                                        label=label, archive=self.archive, resolver=resolver,
+                                                        proximity=proximity)
+                geocoded_df = pd.concat([geocoded_df, pending_geocoded_df], ignore_index=True)
+                geocoded_df = geocoded_df.drop_duplicates(subset=CONTRACT_KEY, keep='last')
+            get_metrics().inc('stage_rows_total', len(geocoded_df), stage='geocode')
+            return year, opst, geocoded_df
+
+        def write(item):
+            year, opst, geocoded_df = item
+            rows = self.store.write_partition('geocoded', year, opst, geocoded_df)
+            get_metrics().inc('stage_rows_total', rows, stage='write')
+
+        def close():
+            cache.log_stats()
+            proximity.log_stats()
+            limiter.log_stats()
+
+        return Pipeline([Stage('geocode', geocode, maxsize=0), Stage('write', write)], on_close=close)
+
+    def geocode_years(self, years, deltas=None):
+        """
+        Geocode opstinas which have no address columns yet, and the new or changed rows of already geocoded ones.
 
-        return updated_mark
+        :param years: list of int
+        :param deltas: dict {year: {opstina: pd.DataFrame}}, as returned by update_year_data
+        :return: int, number of geocoded partitions written
+        """
+        pipeline = self.geocoding_pipeline(deltas)
+        try:
+            for year in years:
+                for opst in self.store.partitions('contracts', year):
+                    pipeline.put((year, opst))
+        finally:
+            written = pipeline.close()
+        print(f'Geocoded partitions: {written}')
+        return written
 
     @staticmethod
     def check_files():
@@ -294,28 +806,65 @@ class Scraper:
         #         del df['location']
         #         df.to_csv(f_, index=False)
 
-    @staticmethod
-    def get_result_file():
-        filepath_data_xlsx = OUTPUT_FOLDER.joinpath("contracts.xlsx")
-        if os.path.exists(filepath_data_xlsx):
-            filepath_data_xlsx.unlink()
-        print('Creating result file')
-        with pd.ExcelWriter(filepath_data_xlsx) as writer:
-            for f_ in OUTPUT_FOLDER.glob(f'contracts_*.xlsx'):
-                print(f"Creating {f_.name} list")
-                pd.read_excel(f_).to_excel(writer, sheet_name=f"{f_.name.split('_')[1]}", index=False)
+    def get_result_file(self):
+        """
+        Render geocoded contracts of all complete years into contracts.xlsx, one sheet per year,
+        and bring the query index up to date.
+
+        :return: None
+        """
+        with self._result_lock:
+            if EXPORT_XLSX:
+                with get_metrics().stage('export'):
+                    rows = export_store(self.store, OUTPUT_FOLDER.joinpath("contracts.xlsx"))
+                get_metrics().inc('stage_rows_total', rows, stage='export')
+            if self.index is not None:
+                with get_metrics().stage('index'):
+                    self.index.refresh(self.store)
+
+    def collect_on_demand(self, year, opstinas=None):
+        """
+        Collect a year, or some of its opstinas, on request: opstinas which aren't collected yet are collected,
+        stored ones are updated from their watermarks. Both are geocoded and the result file is rendered.
+
+        :param year: int
+        :param opstinas: list of str, all opstinas if None
+        :return: None
+        """
+        unknown = set(opstinas or []) - set(self.parameters.opstina_list)
+        if unknown:
+            raise ValueError(f'unknown opstinas {sorted(unknown)}')
+        with get_metrics().run('on_demand'):
+            opstinas = opstinas or self.parameters.opstina_list
+            stored = [opst for opst in opstinas if self.store.has_partition('contracts', year, opst)]
+            deltas, changes = {year: {}}, []
+            if stored:
+                deltas[year], changes = self.update_year_data(year, stored)
+            changes += self.collect_new_opstinas(year, opstinas)
+            self.geocode_years([year], deltas)
+            self.get_result_file()
+            self.changes.write(year, changes, self.store)
+            print(f'Collected {year} on demand: {len(stored)} opstinas updated, '
+                  f'{len(opstinas) - len(stored)} collected')
 
     def update_data(self):
-        print('Updating data')
-        year = datetime.now().year
-        filepath_last_year = Path(f"../data/contracts_{year}.csv")
-        last_year_xlsx_name = f"contracts_{year}_with_location.xlsx"
-        filepath_last_year_xlsx = OUTPUT_FOLDER.joinpath(last_year_xlsx_name)
-        filepath_last_year.unlink(missing_ok=True)
-        filepath_last_year_xlsx.unlink(missing_ok=True)
-        self.collect_year_data(year)
-        print(f'started {year} geodata collecting process')
-        process_folder(INPUT_FOLDER, OUTPUT_FOLDER, max_workers=2)
-        self.get_result_file()
-        print(f'Updated {year} year')
+        """
+        Weekly update of the current year. If the year has been collected already, only contracts newer than
+        the watermarks are requested and only those rows are geocoded.
+        The new, changed and removed rows are written as delta files of the ChangeLog.
 
+        :return: None
+        """
+        with get_metrics().run('update_data'):
+            print('Updating data')
+            year = datetime.now().year
+            deltas = {}
+            if not self.store.has_year(year):
+                changes = self.collect_new_opstinas(year)
+            else:
+                deltas[year], changes = self.update_year_data(year)
+            print(f'started {year} geodata collecting process')
+            self.geocode_years([year], deltas)
+            self.get_result_file()
+            self.changes.write(year, changes, self.store)
+            print(f'Updated {year} year')
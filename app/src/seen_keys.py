@@ -0,0 +1,174 @@
+import sqlite3
+import threading
+
+from pathlib import Path
+
+import pandas as pd
+
+from constants import SEEN_KEYS_PATH, CONTRACT_KEY
+
+
+class SeenKeys:
+    """
+    Persistent (SQLite) index of the contract keys (contract ID, object ID) in the store, across all years,
+    with a fingerprint of each row's values and the partition holding it.
+    Incoming batches are filtered against it, so new and changed rows are found without reading partitions.
+
+    Fingerprints are computed on frames typed as CONTRACTS_SCHEMA; all producers of contract frames return them.
+    Partitions written before the index existed are registered lazily (see Scraper.register_partition).
+    """
+
+    def __init__(self, path=SEEN_KEYS_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS seen ('
+            'contract_id INTEGER, '
+            'object_id INTEGER, '
+            'fingerprint INTEGER, '
+            'year INTEGER, '
+            'opstina TEXT, '
+            'PRIMARY KEY (contract_id, object_id)) WITHOUT ROWID'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS partition ('
+            'year INTEGER, '
+            'opstina TEXT, '
+            'PRIMARY KEY (year, opstina))'
+        )
+        self._conn.execute(
+            'CREATE TEMP TABLE batch (position INTEGER PRIMARY KEY, contract_id INTEGER, object_id INTEGER, '
+            'fingerprint INTEGER)'
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def fingerprints(df):
+        """
+        :return: list of int, a 64-bit hash of every row's values
+        """
+        # the KO a row was requested for isn't part of its values, so rows stored without it keep their fingerprints
+        df = df.drop(columns=['kat_opstina'], errors='ignore')
+        return pd.util.hash_pandas_object(df, index=False).to_numpy().view('int64').tolist()
+
+    @staticmethod
+    def _keys(df):
+        return [[None if pd.isna(value) else int(value) for value in df[column]] for column in CONTRACT_KEY]
+
+    def filter(self, df):
+        """
+        Rows of a batch that aren't stored yet or differ from the stored row with the same key.
+        Within the batch the last row of a key wins.
+
+        :param df: pd.DataFrame typed as CONTRACTS_SCHEMA
+        :return: pd.DataFrame
+        """
+        df = df.drop_duplicates(subset=CONTRACT_KEY, keep='last')
+        if df.empty:
+            return df
+        contract_ids, object_ids = self._keys(df)
+        with self._lock:
+            self._conn.execute('DELETE FROM batch')
+            self._conn.executemany('INSERT INTO batch VALUES (?, ?, ?, ?)',
+                                   zip(range(len(df)), contract_ids, object_ids, self.fingerprints(df)))
+            known = [row[0] for row in self._conn.execute(
+                'SELECT batch.position FROM batch JOIN seen '
+                'ON seen.contract_id = batch.contract_id AND seen.object_id = batch.object_id '
+                'AND seen.fingerprint = batch.fingerprint'
+            )]
+            self._conn.execute('DELETE FROM batch')
+            self._conn.commit()
+        mask = pd.Series(True, index=range(len(df)))
+        mask[known] = False
+        return df[mask.to_numpy()]
+
+    def unseen(self, df, year, opstina):
+        """
+        Rows of a batch whose key isn't recorded for the partition yet. Within the batch the first row of a key wins.
+
+        :param df: pd.DataFrame typed as CONTRACTS_SCHEMA
+        :return: pd.DataFrame
+        """
+        df = df.drop_duplicates(subset=CONTRACT_KEY, keep='first')
+        if df.empty:
+            return df
+        contract_ids, object_ids = self._keys(df)
+        with self._lock:
+            self._conn.execute('DELETE FROM batch')
+            self._conn.executemany('INSERT INTO batch VALUES (?, ?, ?, NULL)',
+                                   zip(range(len(df)), contract_ids, object_ids))
+            known = [row[0] for row in self._conn.execute(
+                'SELECT batch.position FROM batch JOIN seen '
+                'ON seen.contract_id = batch.contract_id AND seen.object_id = batch.object_id '
+                'AND seen.year = ? AND seen.opstina = ?', (year, str(opstina))
+            )]
+            self._conn.execute('DELETE FROM batch')
+            self._conn.commit()
+        mask = pd.Series(True, index=range(len(df)))
+        mask[known] = False
+        return df[mask.to_numpy()]
+
+    def add(self, df, year, opstina):
+        """
+        Record stored rows, replacing earlier fingerprints of the same keys.
+        """
+        if df.empty:
+            return
+        contract_ids, object_ids = self._keys(df)
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO seen (contract_id, object_id, fingerprint, year, opstina) '
+                'VALUES (?, ?, ?, ?, ?)',
+                zip(contract_ids, object_ids, self.fingerprints(df), [year] * len(df), [str(opstina)] * len(df))
+            )
+            self._conn.commit()
+
+    def remove(self, df):
+        """
+        Forget the keys of rows removed from the store.
+        """
+        if df.empty:
+            return
+        with self._lock:
+            self._conn.executemany('DELETE FROM seen WHERE contract_id = ? AND object_id = ?', zip(*self._keys(df)))
+            self._conn.commit()
+
+    def has_partition(self, year, opstina):
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM partition WHERE year = ? AND opstina = ?',
+                                     (year, str(opstina))).fetchone()
+        return row is not None
+
+    def add_partition(self, df, year, opstina):
+        """
+        Record all rows of a partition and mark it registered.
+        """
+        self.add(df, year, opstina)
+        self.mark_partition(year, opstina)
+
+    def mark_partition(self, year, opstina):
+        """
+        Mark a partition registered, once all its rows are recorded.
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR IGNORE INTO partition (year, opstina) VALUES (?, ?)', (year, str(opstina)))
+            self._conn.commit()
+
+    def drop_partition(self, year, opstina):
+        with self._lock:
+            self._conn.execute('DELETE FROM seen WHERE year = ? AND opstina = ?', (year, str(opstina)))
+            self._conn.execute('DELETE FROM partition WHERE year = ? AND opstina = ?', (year, str(opstina)))
+            self._conn.commit()
+
+    def drop_year(self, year):
+        with self._lock:
+            self._conn.execute('DELETE FROM seen WHERE year = ?', (year,))
+            self._conn.execute('DELETE FROM partition WHERE year = ?', (year,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
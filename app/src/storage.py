@@ -0,0 +1,282 @@
+import os
+import time
+import shutil
+import logging
+
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from constants import PARQUET_FOLDER, CONTRACT_KEY
+from geo_and_xlsx_conversion import GEO_COLUMNS, APPROXIMATED_COLUMN
+from watermark import parse_contract_dates
+
+# low-cardinality strings, pd.Categorical in memory
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+# typed contracts: parse_data, the store and the export all use these types.
+# Missing prices and areas ('pov') are NaN; coordinates stay float64, float32 would lose ~1 m.
+CONTRACTS_SCHEMA = pa.schema([
+    ('contract ID', pa.int64()),
+    ('date', pa.timestamp('ms')),
+    ('contract type', CATEGORY),
+    ('contract description', CATEGORY),
+    ('contract price', pa.float64()),
+    ('currency', CATEGORY),
+    ('object ID', pa.int64()),
+    ('object category', CATEGORY),
+    ('pov', pa.float64()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    # katastarska opstina the row was requested for; null in partitions written before it was stored
+    ('kat_opstina', CATEGORY),
+])
+
+# geocoded enrichment: address columns per contract key, joined to contracts on export
+GEOCODED_SCHEMA = pa.schema(
+    [CONTRACTS_SCHEMA.field(column) for column in CONTRACT_KEY] + [(column, pa.string()) for column in GEO_COLUMNS]
+    + [(APPROXIMATED_COLUMN, pa.bool_())]
+)
+
+SCHEMAS = {
+    'contracts': CONTRACTS_SCHEMA,
+    'geocoded': GEOCODED_SCHEMA,
+}
+
+
+def as_strings(column):
+    return column.astype(object).where(column.notna(), None).map(lambda value: value if value is None else str(value))
+
+
+def conform(df, schema):
+    """
+    Coerce a DataFrame to the columns and types of a pyarrow schema.
+    Values that can't be converted (e.g. '-' for a missing area) become nulls.
+    """
+    df = df.reindex(columns=schema.names)
+    for field in schema:
+        column = df[field.name]
+        if pa.types.is_integer(field.type):
+            df[field.name] = pd.to_numeric(column, errors='coerce').astype('Int64')
+        elif pa.types.is_floating(field.type):
+            df[field.name] = pd.to_numeric(column, errors='coerce').astype('float64')
+        elif pa.types.is_boolean(field.type):
+            df[field.name] = column.astype(object).where(column.notna(), None).astype('boolean')
+        elif pa.types.is_timestamp(field.type):
+            df[field.name] = parse_contract_dates(column)
+        elif pa.types.is_dictionary(field.type):
+            if not (isinstance(column.dtype, pd.CategoricalDtype) and column.cat.categories.dtype == object):
+                df[field.name] = as_strings(column).astype('category')
+        else:
+            df[field.name] = as_strings(column)
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def typed(df, schema):
+    """
+    :return: pd.DataFrame with the columns and pandas dtypes of a pyarrow schema
+    """
+    return conform(df, schema).to_pandas()
+
+
+def memory_mb(df):
+    """
+    :return: float, size of the DataFrame in memory in MB
+    """
+    return df.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def read_parquet(path, schema, columns=None):
+    """
+    Read a Parquet file as a typed DataFrame. Files written with an older schema
+    (e.g. string dates and areas, no 'approximated' or 'kat_opstina' column) are converted on read.
+    """
+    if columns is not None:
+        # columns added to the schema later are filled with nulls by typed()
+        available = set(pq.read_schema(path).names)
+        table = pq.read_table(path, columns=[column for column in columns if column in available])
+    else:
+        table = pq.read_table(path)
+    expected = pa.schema([schema.field(name) for name in (columns or schema.names)])
+    if table.schema.remove_metadata().equals(expected):
+        return table.to_pandas()
+    return typed(table.to_pandas(), expected)
+
+
+class ChunkedParquetWriter:
+    """
+    Appends DataFrame batches to a '.part' Parquet file as row groups, so memory is bounded by one batch.
+    close() publishes the file under its final name; an interrupted run never leaves a complete-looking file.
+    """
+
+    def __init__(self, path, schema):
+        self.path = Path(path)
+        self.part_path = self.path.with_name(self.path.name + '.part')
+        self.schema = schema
+        self.rows = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.part_path.unlink(missing_ok=True)
+        self._writer = pq.ParquetWriter(self.part_path, schema)
+
+    def append(self, df):
+        if df.empty:
+            return
+        self._writer.write_table(conform(df, self.schema))
+        self.rows += len(df)
+
+    def close(self):
+        """
+        :return: int, number of rows written
+        """
+        self._writer.close()
+        os.replace(self.part_path, self.path)
+        return self.rows
+
+
+class ContractStore:
+    """
+    Parquet datasets partitioned by year and opstina:
+    'contracts' holds the scraped contracts, 'geocoded' the address columns per contract key.
+    A year is complete once all its opstinas are collected and a '_SUCCESS' marker is written.
+    """
+
+    def __init__(self, root=PARQUET_FOLDER):
+        self.root = Path(root)
+
+    def year_path(self, dataset, year):
+        return self.root.joinpath(dataset, f'year={year}')
+
+    def partition_path(self, dataset, year, opst):
+        return self.year_path(dataset, year).joinpath(f'opstina={opst}', 'part-0.parquet')
+
+    def has_partition(self, dataset, year, opst):
+        return self.partition_path(dataset, year, opst).exists()
+
+    def partitions(self, dataset, year):
+        """
+        :return: list of str, opstinas stored for the year
+        """
+        return sorted(path.parent.name.split('=', 1)[1]
+                      for path in self.year_path(dataset, year).glob('opstina=*/part-0.parquet'))
+
+    def writer(self, dataset, year, opst):
+        return ChunkedParquetWriter(self.partition_path(dataset, year, opst), SCHEMAS[dataset])
+
+    def write_partition(self, dataset, year, opst, df):
+        writer = self.writer(dataset, year, opst)
+        writer.append(df)
+        return writer.close()
+
+    def task_path(self, task):
+        """
+        Path of the batch of a single CollectTask, kept until its opstina is compacted.
+        """
+        return self.year_path('contracts', task.year).joinpath(
+            f'opstina={task.opstina}', '_tasks', f'{task.kat_opstina}_{task.start_date}_{task.finish_date}.parquet')
+
+    def write_task(self, task, df):
+        writer = ChunkedParquetWriter(self.task_path(task), CONTRACTS_SCHEMA)
+        writer.append(df)
+        return writer.close()
+
+    def compact_opstina(self, year, opst, tasks, seen):
+        """
+        Stream the batches of all tasks of an opstina into its partition and remove the batch files.
+        A key (contract ID, object ID) already written by an earlier batch is skipped: written keys are
+        recorded in the SeenKeys index batch by batch, so memory doesn't grow with the partition.
+        The partition is registered in the index once it is published.
+
+        :param seen: SeenKeys
+        :return: int, number of rows written
+        """
+        # keys of an interrupted compaction were recorded, but never published
+        seen.drop_partition(year, opst)
+        writer = self.writer('contracts', year, opst)
+        for task in tasks:
+            df = seen.unseen(read_parquet(self.task_path(task), CONTRACTS_SCHEMA), year, opst)
+            writer.append(df)
+            seen.add(df, year, opst)
+        rows = writer.close()
+        seen.mark_partition(year, opst)
+        shutil.rmtree(self.year_path('contracts', year).joinpath(f'opstina={opst}', '_tasks'), ignore_errors=True)
+        return rows
+
+    def read_partition(self, dataset, year, opst, columns=None):
+        path = self.partition_path(dataset, year, opst)
+        if not path.exists():
+            return SCHEMAS[dataset].empty_table().to_pandas()
+        return read_parquet(path, SCHEMAS[dataset], columns)
+
+    def read_year(self, dataset, year, columns=None):
+        """
+        All partitions of a year in one DataFrame; its size in memory and the load time are reported.
+        """
+        started = time.monotonic()
+        frames = [self.read_partition(dataset, year, opst, columns) for opst in self.partitions(dataset, year)]
+        if not frames:
+            return SCHEMAS[dataset].empty_table().to_pandas()
+        # union of the categories of all partitions, so categorical columns stay categorical after concat
+        df = pd.concat(frames, ignore_index=True)
+        for column in df.columns:
+            if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype('category')
+        stats_msg = f'{dataset} {year}: {len(df)} rows, {memory_mb(df):.1f} MB in memory, ' \
+                    f'loaded in {time.monotonic() - started:.2f}s'
+        print(stats_msg)
+        logging.info(stats_msg)
+        return df
+
+    def read_partition_geocoded(self, year, opst):
+        """
+        Contracts of an opstina joined with their address columns.
+        """
+        contracts_df = self.read_partition('contracts', year, opst).drop_duplicates()
+        geocoded_df = self.read_partition('geocoded', year, opst)
+        return contracts_df.merge(geocoded_df.drop_duplicates(subset=CONTRACT_KEY, keep='last'),
+                                  on=CONTRACT_KEY, how='left')
+
+    def iter_year_geocoded(self, year):
+        """
+        Contracts of a year joined with their address columns, one DataFrame per opstina.
+        The rows, the largest partition in memory and the load time are reported once the year is read.
+        """
+        rows, largest_mb, load_seconds = 0, 0.0, 0.0
+        for opst in self.partitions('contracts', year):
+            started = time.monotonic()
+            df = self.read_partition_geocoded(year, opst)
+            load_seconds += time.monotonic() - started
+            rows += len(df)
+            largest_mb = max(largest_mb, memory_mb(df))
+            yield df
+        stats_msg = f'geocoded {year}: {rows} rows, largest partition {largest_mb:.1f} MB in memory, ' \
+                    f'loaded in {load_seconds:.2f}s'
+        print(stats_msg)
+        logging.info(stats_msg)
+
+    def read_year_geocoded(self, year):
+        """
+        Contracts of a year joined with their address columns.
+        """
+        frames = list(self.iter_year_geocoded(year))
+        if not frames:
+            return pd.DataFrame(columns=CONTRACTS_SCHEMA.names + GEO_COLUMNS + [APPROXIMATED_COLUMN])
+        return pd.concat(frames, ignore_index=True)
+
+    def has_year(self, year):
+        return self.year_path('contracts', year).joinpath('_SUCCESS').exists()
+
+    def mark_year_complete(self, year):
+        self.year_path('contracts', year).mkdir(parents=True, exist_ok=True)
+        self.year_path('contracts', year).joinpath('_SUCCESS').touch()
+
+    def years(self):
+        """
+        :return: list of int, complete years
+        """
+        return sorted(int(path.parent.name.split('=', 1)[1])
+                      for path in self.root.joinpath('contracts').glob('year=*/_SUCCESS'))
+
+    def drop_year(self, dataset, year):
+        shutil.rmtree(self.year_path(dataset, year), ignore_errors=True)
@@ -0,0 +1,108 @@
+import sqlite3
+import threading
+
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from constants import WATERMARK_PATH, UPDATE_OVERLAP_DAYS
+
+
+def parse_contract_dates(dates):
+    """
+    Parse the 'date' column of contracts. Katastar returns either ISO dates or ASP.NET '/Date(<ms>)/' values.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return pd.Series(dates)
+    dates = pd.Series(dates, dtype=object).astype(str)
+    ms = pd.to_numeric(dates.str.extract(r'/Date\((-?\d+)', expand=False), errors='coerce')
+    parsed = pd.to_datetime(dates.where(ms.isna()), errors='coerce', format='ISO8601')
+    return parsed.fillna(pd.to_datetime(ms, unit='ms'))
+
+
+class WatermarkStore:
+    """
+    Persistent high-water marks (latest contract date and ID) per (opstina, katastarska opstina).
+    """
+
+    def __init__(self, path=WATERMARK_PATH, overlap_days=UPDATE_OVERLAP_DAYS):
+        self.path = Path(path)
+        self.overlap_days = overlap_days
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS watermark ('
+            'opstina TEXT, '
+            'kat_opstina TEXT, '
+            'last_date TEXT, '
+            'last_id INTEGER, '
+            'updated_at TEXT, '
+            'PRIMARY KEY (opstina, kat_opstina))'
+        )
+        self._conn.commit()
+
+    def get(self, opstina, kat_opstina):
+        """
+        Return (last_date, last_id) or (None, None) if no contract has been seen yet.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT last_date, last_id FROM watermark WHERE opstina = ? AND kat_opstina = ?',
+                (str(opstina), str(kat_opstina))
+            ).fetchone()
+        if row is None:
+            return None, None
+        return datetime.fromisoformat(row[0]), row[1]
+
+    def get_start_date(self, year, opstina, kat_opstina):
+        """
+        First date to query in the year: the watermark minus the overlap window, at the earliest 01.01.
+        Watermarks aren't kept per year, so a year other than the watermark's is queried from 01.01.
+
+        :return: str, 'dd.mm.yyyy'
+        """
+        start = datetime(year, 1, 1)
+        last_date, _ = self.get(opstina, kat_opstina)
+        if last_date is not None and last_date.year == year:
+            start = max(start, last_date - timedelta(days=self.overlap_days))
+        return start.strftime('%d.%m.%Y')
+
+    @staticmethod
+    def from_contracts(contracts_df):
+        """
+        Compute (last_date, last_id) of a batch of parsed contracts, or None for an empty batch.
+        """
+        if contracts_df.empty:
+            return None
+        last_date = parse_contract_dates(contracts_df['date']).max()
+        last_id = pd.to_numeric(contracts_df['contract ID'], errors='coerce').max()
+        if pd.isna(last_date):
+            return None
+        return last_date.to_pydatetime(), None if pd.isna(last_id) else int(last_id)
+
+    def update(self, marks):
+        """
+        Advance watermarks; never moves a watermark backwards.
+
+        :param marks: dict {(opstina, kat_opstina): (last_date, last_id)}
+        """
+        now = datetime.now().isoformat()
+        with self._lock:
+            self._conn.executemany(
+                'INSERT INTO watermark (opstina, kat_opstina, last_date, last_id, updated_at) '
+                'VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (opstina, kat_opstina) DO UPDATE SET '
+                'last_date = MAX(last_date, excluded.last_date), '
+                'last_id = MAX(COALESCE(last_id, 0), COALESCE(excluded.last_id, 0)), '
+                'updated_at = excluded.updated_at',
+                [(str(opst), str(kat_opst), last_date.isoformat(), last_id, now)
+                 for (opst, kat_opst), (last_date, last_id) in marks.items()]
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()